@@ -9,12 +9,14 @@ from aws_cdk import (
     aws_iam as iam,
     aws_ec2 as ec2,
     aws_ecs as ecs,
-    core as cdk
+    core as cdk,
+    custom_resources as cr
 )
 
 
 RUNTIME_SOURCE_DIR = os.path.join(
     os.path.dirname(os.path.dirname(__file__)), os.pardir, 'runtime')
+UPDATE_CONTAINER_NAME = "ShadowStarUpdateTaskContainer"
 
 
 class ChaliceApp(cdk.Stack):
@@ -26,6 +28,7 @@ class ChaliceApp(cdk.Stack):
         self.system_version = system_version
         self._create_athena_s3_bucket()
         self._create_athena_database()
+        self._migrate_network_info()
         self._create_fargate_cluster()
         self._create_fargate_task()
         self.chalice = Chalice(
@@ -36,11 +39,13 @@ class ChaliceApp(cdk.Stack):
                 'environment_variables': {
                     'ATHENA_BUCKET': self.athena_bucket.bucket_name,
                     'ATHENA_TABLE': self.athena_table.table_input.name,
+                    'ATHENA_DELTA_TABLE': self.athena_delta_table.table_input.name,
                     'ATHENA_DATABASE': self.athena_database.database_name,
                     'VPC_DEFAULT_SG': self.vpc.vpc_default_security_group,
                     'VPC_DEFAULT_SUBNET': self.vpc.public_subnets[0].subnet_id,
                     'ECS_CLUSTER_NAME': self.cluster.cluster_name,
-                    'ECS_TASK_DEFINITION': self.task_definition.task_definition_arn
+                    'ECS_TASK_DEFINITION': self.task_definition.task_definition_arn,
+                    'ECS_CONTAINER_NAME': UPDATE_CONTAINER_NAME
                 }
             }
         )
@@ -58,8 +63,25 @@ class ChaliceApp(cdk.Stack):
                     resources=[
                         f'arn:aws:glue:{self.region}:{self.account}:catalog',
                         f'arn:aws:glue:{self.region}:{self.account}:database/{self.athena_database.database_name}',
-                        f'arn:aws:glue:{self.region}:{self.account}:table/{self.athena_database.database_name}/{self.athena_table.table_input.name}'
+                        f'arn:aws:glue:{self.region}:{self.account}:table/{self.athena_database.database_name}/{self.athena_table.table_input.name}',
+                        f'arn:aws:glue:{self.region}:{self.account}:table/{self.athena_database.database_name}/{self.athena_delta_table.table_input.name}'
                     ]
+                ),
+                # The runtime shares its boto3 clients between handlers, which
+                # hides the calls from Chalice's policy generator.
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        'athena:StartQueryExecution',
+                        'athena:GetQueryExecution',
+                        'athena:GetQueryRuntimeStatistics'
+                    ],
+                    resources=[f'arn:aws:athena:{self.region}:{self.account}:workgroup/primary']
+                ),
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['ecs:ListTasks', 'ecs:RunTask'],
+                    resources=['*']
                 )
             ]
         ))
@@ -88,20 +110,97 @@ class ChaliceApp(cdk.Stack):
             "ShadowStarAthenaDB",
             database_name="shadowstar_athena_db"
         )
-        self.athena_table = glue.CfnTable(
-            self,
+        # Each table gets its own prefix; Athena reads every object below a
+        # table's location, so the delta must not live below the main table.
+        self.athena_table = self._create_athena_table(
             "ShadowStarAthenaTable",
+            "shadowstar_athena_table",
+            "network_info/",
+            []
+        )
+        self.athena_delta_table = self._create_athena_table(
+            "ShadowStarAthenaDeltaTable",
+            "shadowstar_athena_delta_table",
+            "delta/",
+            [glue.CfnTable.ColumnProperty(name="change", type="string")]
+        )
+
+    def _migrate_network_info(self):
+        # Deployments from before the tables had prefixes of their own kept the
+        # TSV file at the bucket root, where the main table no longer looks.
+        # Move it below the table so it is searchable right away and the next
+        # update computes its delta against it; a missing object (a new
+        # bucket) is not an error. CopyObject handles objects up to 5 GB.
+        bucket = self.athena_bucket.bucket_name
+        copy = cr.AwsCustomResource(
+            self,
+            "ShadowStarMigrateNetworkInfoCopy",
+            on_create=cr.AwsSdkCall(
+                service='S3',
+                action='copyObject',
+                parameters={
+                    'Bucket': bucket,
+                    'CopySource': f"{bucket}/network_info.tsv",
+                    'Key': 'network_info/network_info.tsv'
+                },
+                physical_resource_id=cr.PhysicalResourceId.of('ShadowStarMigrateNetworkInfoCopy'),
+                ignore_error_codes_matching='NoSuchKey'
+            ),
+            policy=cr.AwsCustomResourcePolicy.from_statements([
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['s3:GetObject', 's3:PutObject'],
+                    resources=[
+                        self.athena_bucket.arn_for_objects('network_info.tsv'),
+                        self.athena_bucket.arn_for_objects('network_info/network_info.tsv')
+                    ]
+                ),
+                # Without it a missing object is reported as AccessDenied
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['s3:ListBucket'],
+                    resources=[self.athena_bucket.bucket_arn]
+                )
+            ])
+        )
+        # Deleting an object which does not exist succeeds
+        delete = cr.AwsCustomResource(
+            self,
+            "ShadowStarMigrateNetworkInfoDelete",
+            on_create=cr.AwsSdkCall(
+                service='S3',
+                action='deleteObject',
+                parameters={
+                    'Bucket': bucket,
+                    'Key': 'network_info.tsv'
+                },
+                physical_resource_id=cr.PhysicalResourceId.of('ShadowStarMigrateNetworkInfoDelete')
+            ),
+            policy=cr.AwsCustomResourcePolicy.from_statements([
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['s3:DeleteObject'],
+                    resources=[self.athena_bucket.arn_for_objects('network_info.tsv')]
+                )
+            ])
+        )
+        delete.node.add_dependency(copy)
+
+    def _create_athena_table(self, id, name, prefix, extra_columns):
+        return glue.CfnTable(
+            self,
+            id,
             database_name=self.athena_database.database_name,
             catalog_id=self.account,
             table_input=glue.CfnTable.TableInputProperty(
-                name="shadowstar_athena_table",
+                name=name,
                 table_type="EXTERNAL_TABLE",
                 parameters={
                     'EXTERNAL': "TRUE",
                     'has_encrypted_data': False
                 },
                 storage_descriptor=glue.CfnTable.StorageDescriptorProperty(
-                    columns=[
+                    columns=extra_columns + [
                         glue.CfnTable.ColumnProperty(name="inetnum", type="string"),
                         glue.CfnTable.ColumnProperty(name="netname", type="string"),
                         glue.CfnTable.ColumnProperty(name="description", type="string"),
@@ -111,7 +210,7 @@ class ChaliceApp(cdk.Stack):
                         glue.CfnTable.ColumnProperty(name="last_modified", type="string"),
                         glue.CfnTable.ColumnProperty(name="source", type="string"),
                     ],
-                    location=f"s3://{self.athena_bucket.bucket_name}/",
+                    location=f"s3://{self.athena_bucket.bucket_name}/{prefix}",
                     input_format="org.apache.hadoop.mapred.TextInputFormat",
                     output_format="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
                     compressed=False,
@@ -149,10 +248,31 @@ class ChaliceApp(cdk.Stack):
                         effect=iam.Effect.ALLOW,
                         actions=['s3:PutObject'],
                         resources=[
-                            self.athena_bucket.arn_for_objects('network_info.tsv'),
-                            self.athena_bucket.arn_for_objects('metadata/metadata.json')
+                            self.athena_bucket.arn_for_objects('network_info/network_info.tsv'),
+                            self.athena_bucket.arn_for_objects('delta/delta.tsv'),
+                            self.athena_bucket.arn_for_objects('metadata/metadata.json'),
+                            self.athena_bucket.arn_for_objects('parts/*'),
+                            self.athena_bucket.arn_for_objects('watchlist-results/*')
+                        ]
+                    ),
+                    # The previous build is needed to compute the delta, the
+                    # parts of every source to merge them and the watchlists
+                    # to evaluate them
+                    iam.PolicyStatement(
+                        effect=iam.Effect.ALLOW,
+                        actions=['s3:GetObject'],
+                        resources=[
+                            self.athena_bucket.arn_for_objects('network_info/network_info.tsv'),
+                            self.athena_bucket.arn_for_objects('parts/*'),
+                            self.athena_bucket.arn_for_objects('watchlists/*')
                         ]
                     ),
+                    iam.PolicyStatement(
+                        effect=iam.Effect.ALLOW,
+                        actions=['s3:ListBucket'],
+                        resources=[self.athena_bucket.bucket_arn],
+                        conditions={'StringLike': {'s3:prefix': ['watchlists/*']}}
+                    ),
                     iam.PolicyStatement(
                         effect=iam.Effect.ALLOW,
                         actions=['secretsmanager:GetSecretValue'],
@@ -163,7 +283,9 @@ class ChaliceApp(cdk.Stack):
         )
         # 8 GB seems like a lot of memory; but it is needed to hold the large
         # data dumps in memory all at once. You could do this much better with
-        # a different language, but good RPSL parsers are hard to find.
+        # a different language, but good RPSL parsers are hard to find. These
+        # are the defaults for a full run; the update runs one task per source
+        # and the runtime overrides the size of each (see SOURCE_TASK_SIZES).
         self.task_definition = ecs.FargateTaskDefinition(
             self,
             "ShadowStarUpdateTask",
@@ -172,12 +294,16 @@ class ChaliceApp(cdk.Stack):
             task_role=self.task_role
         )
         self.task_definition.add_container(
-            "ShadowStarUpdateTaskContainer",
+            UPDATE_CONTAINER_NAME,
             image=ecs.ContainerImage.from_asset("../../shadowstar_db_parser"),
             environment={
                 "S3_BUCKET": self.athena_bucket.bucket_name,
-                "S3_PATH": "network_info.tsv",
+                "S3_PATH": "network_info/network_info.tsv",
                 "S3_METADATA_PATH": "metadata/metadata.json",
+                "S3_DELTA_PATH": "delta/delta.tsv",
+                "S3_PARTS_PREFIX": "parts/",
+                "S3_WATCHLIST_PREFIX": "watchlists/",
+                "S3_WATCHLIST_RESULTS_PREFIX": "watchlist-results/",
                 "SYSTEM_VERSION": self.system_version,
                 "ARIN_SECRET_NAME": self.arin_secret_name
             },
@@ -1,16 +1,20 @@
 import re
 import os
 import json
+import time
 
-import boto3
+from datetime import datetime, timedelta, timezone
 
+import boto3
 
-from chalice import Chalice, Rate
-from chalice.app import BadRequestError
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from chalice import Chalice, Rate, BadRequestError, NotFoundError, ChaliceViewError
 
 
 app = Chalice(app_name='shadowstar_api')
-app.debug = True
+app.debug = os.environ.get('DEBUG', '').lower() in ['1', 'true', 'yes']
+app.log.setLevel('INFO')
 
 S3_BUCKET_RE = re.compile(r's3://(.*?)/(.*)')
 VALID_SOURCES = [
@@ -20,11 +24,72 @@ VALID_SOURCES = [
 
 ATHENA_BUCKET = os.environ.get('ATHENA_BUCKET')
 ATHENA_TABLE = os.environ.get('ATHENA_TABLE')
+ATHENA_DELTA_TABLE = os.environ.get('ATHENA_DELTA_TABLE')
 ATHENA_DATABASE = os.environ.get('ATHENA_DATABASE')
 VPC_DEFAULT_SG = os.environ.get('VPC_DEFAULT_SG')
 VPC_DEFAULT_SUBNET = os.environ.get('VPC_DEFAULT_SUBNET')
 ECS_CLUSTER_NAME = os.environ.get('ECS_CLUSTER_NAME')
 ECS_TASK_DEFINITION = os.environ.get('ECS_TASK_DEFINITION')
+ECS_CONTAINER_NAME = os.environ.get('ECS_CONTAINER_NAME')
+
+# An update runs one task per source, sized (cpu units, memory MiB) for the
+# dumps of that source alone; ARIN (bulk WHOIS) and RIPE are by far the largest
+# while most IRR mirrors are small. Once the last of them has stopped a single
+# task merges their parts and publishes the build.
+SOURCE_TASK_SIZES = {
+    'arin': ('1024', '8192'),
+    'afrinic': ('256', '2048'),
+    'apnic': ('512', '4096'),
+    'lacnic': ('256', '2048'),
+    'ripe': ('1024', '6144'),
+    'level3': ('256', '2048'),
+    'nttcom': ('256', '2048'),
+    'radb': ('512', '4096'),
+    'tc': ('256', '1024'),
+    'reach': ('256', '1024'),
+    'wcgdb': ('256', '1024'),
+    'jpirr': ('256', '1024')
+}
+MERGE_TASK_SIZE = ('512', '4096')
+
+# Tasks are told apart through startedBy
+SOURCE_TASK_STARTED_BY = 'shadowstar-source'
+MERGE_TASK_STARTED_BY = 'shadowstar-merge'
+MERGE_LOCK_KEY = 'parts/merge.lock'
+# When the current update started; the merge reports older parts as stale
+UPDATE_KEY = 'parts/update.json'
+
+# Clients are created on first use and then kept for the lifetime of the Lambda
+# container so that warm invocations skip client construction, credential
+# resolution and the TLS handshake. API Gateway gives up after 29 seconds, so
+# AWS calls are kept well inside that budget.
+BOTO_CONFIG = Config(
+    connect_timeout=3,
+    read_timeout=10,
+    max_pool_connections=4,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'standard'}
+)
+BOTO_SESSION = boto3.session.Session()
+CLIENTS = {}
+
+COLD_START = True
+
+# Saved keyword sets; the update task evaluates every one of them while it
+# writes the TSV file and stores the (CIDR-reduced) results as <name>.tsv
+WATCHLIST_PREFIX = 'watchlists/'
+WATCHLIST_RESULTS_PREFIX = 'watchlist-results/'
+WATCHLIST_NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Statistics of every completed search are appended to one JSON lines object
+# per (UTC) day, see record_query_stats()
+TELEMETRY_PREFIX = 'telemetry/'
+TELEMETRY_DAYS = 30
+TELEMETRY_RETRIES = 5
+
+# Athena bills per TB scanned, rounded up to the MB with a 10 MB minimum
+ATHENA_PRICE_PER_TB = 5.0
+ATHENA_MIN_BILLED_BYTES = 10 * 1024 * 1024
 
 SQL_SOURCE_CLAUSE = "LOWER(source) LIKE '%s'"
 SQL_SELECT_BLOCKS = '''
@@ -33,47 +98,53 @@ SELECT * FROM %s WHERE
     (LOWER(netname) LIKE '%s' OR LOWER(description) LIKE '%s' OR LOWER(maintained_by) LIKE '%s');
 '''.replace('\n', ' ').replace('\t', ' ')
 
+# Recover the search from the SQL of a finished query
+SQL_TABLE_RE = re.compile(r'SELECT \* FROM (\S+) WHERE')
+SQL_SOURCE_RE = re.compile(r"LOWER\(source\) LIKE '(.*?)'")
+SQL_KEYWORD_RE = re.compile(r"LOWER\(netname\) LIKE '(.*)' OR LOWER\(description\) LIKE")
 
-@app.schedule(Rate(7, unit=Rate.DAYS))
-def schedule_auto_update(event):
-    s3 = boto3.client('s3')
-    ecs = boto3.client('ecs')
-    # Check for existing update jobs
-    res = ecs.list_tasks(cluster=ECS_CLUSTER_NAME)
-    if len(res['taskArns']) == 0:
-        # Run the database update
-        ecs.run_task(
-            cluster=ECS_CLUSTER_NAME,
-            launchType='FARGATE',
-            taskDefinition=ECS_TASK_DEFINITION,
-            networkConfiguration={
-                'awsvpcConfiguration': {
-                    'subnets': [
-                        VPC_DEFAULT_SUBNET,
-                    ],
-                    'securityGroups': [
-                        VPC_DEFAULT_SG
-                    ],
-                    'assignPublicIp': 'ENABLED'
-                }
-            }
-        )
-    # Purge the results from bucket so as not to grow forever
-    res = s3.list_objects(Bucket=ATHENA_BUCKET, Prefix='results/')
-    for key in res['Contents']:
-        s3.delete_object(Bucket=ATHENA_BUCKET, Key=key['Key'])
 
+def get_client(service):
+    if service not in CLIENTS:
+        CLIENTS[service] = BOTO_SESSION.client(service, config=BOTO_CONFIG)
+    return CLIENTS[service]
 
-@app.route('/refresh-db', methods=['POST'], cors=True)
-def refresh_db():
-    ecs = boto3.client('ecs')
-    res = ecs.list_tasks(cluster=ECS_CLUSTER_NAME)
-    if len(res['taskArns']) != 0:
-        raise BadRequestError('Update job already running')
-    ecs.run_task(
+
+@app.middleware('all')
+def log_latency(event, get_response):
+    global COLD_START
+    cold = COLD_START
+    COLD_START = False
+    start = time.perf_counter()
+    try:
+        return get_response(event)
+    finally:
+        # One JSON line per invocation, aggregate with CloudWatch Logs Insights:
+        #   stats avg(duration_ms), pct(duration_ms, 95) by route, cold
+        # The init time of a cold start is the Init Duration of the REPORT line
+        # Lambda itself logs for the same invocation.
+        app.log.info(json.dumps({
+            'route': getattr(event, 'path', None) or type(event).__name__,
+            'cold': cold,
+            'duration_ms': round((time.perf_counter() - start) * 1000, 2)
+        }))
+
+
+def run_update_task(command, size, started_by):
+    cpu, memory = size
+    res = get_client('ecs').run_task(
         cluster=ECS_CLUSTER_NAME,
         launchType='FARGATE',
         taskDefinition=ECS_TASK_DEFINITION,
+        startedBy=started_by,
+        overrides={
+            'cpu': cpu,
+            'memory': memory,
+            'containerOverrides': [{
+                'name': ECS_CONTAINER_NAME,
+                'command': command
+            }]
+        },
         networkConfiguration={
             'awsvpcConfiguration': {
                 'subnets': [
@@ -86,11 +157,83 @@ def refresh_db():
             }
         }
     )
+    for failure in res.get('failures', []):
+        app.log.error('Failed to start update task %s: %s', command, failure)
+    return len(res.get('tasks', [])) > 0
+
+
+def start_update():
+    s3 = get_client('s3')
+    s3.put_object(
+        Bucket=ATHENA_BUCKET,
+        Key=UPDATE_KEY,
+        Body=json.dumps({'started': datetime.now(timezone.utc).isoformat()}).encode()
+    )
+    # Re-arm the merge step, it runs once per update
+    s3.delete_object(Bucket=ATHENA_BUCKET, Key=MERGE_LOCK_KEY)
+    started = [
+        source for source, size in SOURCE_TASK_SIZES.items()
+        if run_update_task(['python3', 'parser.py', '-d', '--source', source], size, SOURCE_TASK_STARTED_BY)
+    ]
+    # Without a source task no task ever stops, so the merge would never run
+    if not started:
+        raise ChaliceViewError('No update task could be started')
+    if len(started) < len(SOURCE_TASK_SIZES):
+        app.log.error('Started update tasks for %s only', ', '.join(started))
+
+
+# The update also refreshes the results of every watchlist
+@app.schedule(Rate(7, unit=Rate.DAYS))
+def schedule_auto_update(event):
+    s3 = get_client('s3')
+    ecs = get_client('ecs')
+    # Check for existing update jobs
+    res = ecs.list_tasks(cluster=ECS_CLUSTER_NAME)
+    if len(res['taskArns']) == 0:
+        # Run the database update
+        start_update()
+    # Purge the results from bucket so as not to grow forever
+    res = s3.list_objects(Bucket=ATHENA_BUCKET, Prefix='results/')
+    for key in res['Contents']:
+        s3.delete_object(Bucket=ATHENA_BUCKET, Key=key['Key'])
+
+
+@app.on_cw_event({
+    'source': ['aws.ecs'],
+    'detail-type': ['ECS Task State Change'],
+    'detail': {
+        'lastStatus': ['STOPPED'],
+        'startedBy': [SOURCE_TASK_STARTED_BY]
+    }
+})
+def merge_update(event):
+    ecs = get_client('ecs')
+    res = ecs.list_tasks(cluster=ECS_CLUSTER_NAME, startedBy=SOURCE_TASK_STARTED_BY)
+    if len(res['taskArns']) != 0:
+        return
+    # Source tasks which stop at the same time all see none left running; only
+    # the one that manages to create the lock starts the merge.
+    try:
+        get_client('s3').put_object(Bucket=ATHENA_BUCKET, Key=MERGE_LOCK_KEY, Body=b'', IfNoneMatch='*')
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ['PreconditionFailed', 'ConditionalRequestConflict']:
+            return
+        raise
+    run_update_task(['python3', 'parser.py', '--merge', '-o', 'network_info.tsv'], MERGE_TASK_SIZE, MERGE_TASK_STARTED_BY)
+
+
+@app.route('/refresh-db', methods=['POST'], cors=True)
+def refresh_db():
+    ecs = get_client('ecs')
+    res = ecs.list_tasks(cluster=ECS_CLUSTER_NAME)
+    if len(res['taskArns']) != 0:
+        raise BadRequestError('Update job already running')
+    start_update()
 
 
 @app.route('/metadata', methods=['GET'], cors=True)
 def metadata():
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
     try:
         res = s3.get_object(Bucket=ATHENA_BUCKET, Key='metadata/metadata.json')
         return res['Body'].read()
@@ -98,13 +241,15 @@ def metadata():
         return json.dumps({
             'system_version': None,
             'num_network_blocks': None,
+            'delta': None,
+            'watchlists': None,
+            'parts': None,
             'last_updated': None
         })
 
 
-@app.route('/query', methods=['POST'], cors=True)
-def query():
-    if any([req in [None, ''] for req in [ATHENA_BUCKET, ATHENA_TABLE, ATHENA_DATABASE]]):
+def start_keyword_query(table):
+    if any([req in [None, ''] for req in [ATHENA_BUCKET, table, ATHENA_DATABASE]]):
         raise BadRequestError('Environment variables are not set')
 
     if 'keyword' not in app.current_request.json_body:
@@ -121,9 +266,9 @@ def query():
 
     keyword = str(app.current_request.json_body['keyword']).lower()
     source_clause = ' OR '.join([SQL_SOURCE_CLAUSE % source for source in sources])
-    query = SQL_SELECT_BLOCKS % (ATHENA_TABLE, source_clause, keyword, keyword, keyword)
+    query = SQL_SELECT_BLOCKS % (table, source_clause, keyword, keyword, keyword)
 
-    athena = boto3.client('athena')
+    athena = get_client('athena')
     qexec = athena.start_query_execution(
         QueryString=query,
         QueryExecutionContext={
@@ -141,13 +286,258 @@ def query():
         raise BadRequestError('Failed to execute Athena query')
 
 
+@app.route('/query', methods=['POST'], cors=True)
+def query():
+    return start_keyword_query(ATHENA_TABLE)
+
+
+# Same search as /query, but against the rows which were added, removed or
+# changed owner in the most recent database update.
+@app.route('/query-delta', methods=['POST'], cors=True)
+def query_delta():
+    return start_keyword_query(ATHENA_DELTA_TABLE)
+
+
+def watchlist_key(name, prefix, extension):
+    if not WATCHLIST_NAME_RE.match(name):
+        raise BadRequestError('Watchlist names may only contain letters, digits, "-" and "_"')
+    return f"{prefix}{name}.{extension}"
+
+
+def list_objects(prefix):
+    s3 = get_client('s3')
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ATHENA_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+@app.route('/watchlists', methods=['GET'], cors=True)
+def list_watchlists():
+    results = {
+        obj['Key'][len(WATCHLIST_RESULTS_PREFIX):-len('.tsv')]: obj['LastModified'].isoformat()
+        for obj in list_objects(WATCHLIST_RESULTS_PREFIX) if obj['Key'].endswith('.tsv')
+    }
+    watchlists = []
+    for obj in list_objects(WATCHLIST_PREFIX):
+        if obj['Key'].endswith('.json'):
+            name = obj['Key'][len(WATCHLIST_PREFIX):-len('.json')]
+            watchlists.append({
+                'name': name,
+                'last_modified': obj['LastModified'].isoformat(),
+                'last_update': results.get(name)
+            })
+    return json.dumps({'watchlists': watchlists})
+
+
+@app.route('/watchlists/{name}', methods=['PUT'], cors=True)
+def save_watchlist(name):
+    key = watchlist_key(name, WATCHLIST_PREFIX, 'json')
+    body = app.current_request.json_body or {}
+
+    keywords = body.get('keywords')
+    if not isinstance(keywords, list) or not keywords or not all([str(keyword).strip('%') for keyword in keywords]):
+        raise BadRequestError('"keywords" body parameter must be a list of keywords')
+    # Watchlists are matched literally by the update task, so only the leading
+    # and trailing % of the LIKE syntax have an equivalent
+    if any(['%' in str(keyword).strip('%') or '_' in str(keyword) for keyword in keywords]):
+        raise BadRequestError('"keywords" body parameter can only use % at the start or end of a keyword')
+    keywords = [str(keyword).lower() for keyword in keywords]
+
+    sources = list(body.get('sources', ['%']))
+    if any([source not in VALID_SOURCES for source in sources]):
+        raise BadRequestError('"sources" body parameter contains an invalid source')
+
+    watchlist = {'keywords': keywords, 'sources': sources}
+    get_client('s3').put_object(Bucket=ATHENA_BUCKET, Key=key, Body=json.dumps(watchlist).encode())
+    return json.dumps(dict(watchlist, name=name))
+
+
+@app.route('/watchlists/{name}', methods=['GET'], cors=True)
+def get_watchlist(name):
+    key = watchlist_key(name, WATCHLIST_PREFIX, 'json')
+    try:
+        res = get_client('s3').get_object(Bucket=ATHENA_BUCKET, Key=key)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] == 'NoSuchKey':
+            raise NotFoundError(f"Watchlist {name} does not exist")
+        raise
+    return json.dumps(dict(json.loads(res['Body'].read()), name=name))
+
+
+@app.route('/watchlists/{name}', methods=['DELETE'], cors=True)
+def delete_watchlist(name):
+    s3 = get_client('s3')
+    s3.delete_object(Bucket=ATHENA_BUCKET, Key=watchlist_key(name, WATCHLIST_PREFIX, 'json'))
+    s3.delete_object(Bucket=ATHENA_BUCKET, Key=watchlist_key(name, WATCHLIST_RESULTS_PREFIX, 'tsv'))
+    return json.dumps({'name': name})
+
+
+# Results are materialized by the update task, so unlike /query there is no
+# Athena query to wait for; the response has the same shape as /retrieve.
+@app.route('/watchlists/{name}/results', methods=['GET'], cors=True)
+def watchlist_results(name):
+    key = watchlist_key(name, WATCHLIST_RESULTS_PREFIX, 'tsv')
+    s3 = get_client('s3')
+    try:
+        res = s3.head_object(Bucket=ATHENA_BUCKET, Key=key)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            raise NotFoundError(f"No results for watchlist {name} yet, they are created by the next database update")
+        raise
+
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': ATHENA_BUCKET, 'Key': key}
+    )
+    return json.dumps({'results': url, 'last_update': res['LastModified'].isoformat()})
+
+
+def append_telemetry(day, execution_id, record):
+    # S3 objects can not be appended to, so the day's log is rewritten with a
+    # conditional put and re-read whenever another invocation got there first.
+    s3 = get_client('s3')
+    key = f"{TELEMETRY_PREFIX}{day}.jsonl"
+    line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+    for _ in range(TELEMETRY_RETRIES):
+        try:
+            res = s3.get_object(Bucket=ATHENA_BUCKET, Key=key)
+            body = res['Body'].read()
+            condition = {'IfMatch': res['ETag']}
+        except ClientError as ex:
+            if ex.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            body = b''
+            condition = {'IfNoneMatch': '*'}
+
+        # Events can be delivered more than once
+        if f'"id":"{execution_id}"'.encode() in body:
+            return
+        try:
+            s3.put_object(Bucket=ATHENA_BUCKET, Key=key, Body=body + line, **condition)
+            return
+        except ClientError as ex:
+            if ex.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                raise
+    app.log.error('Gave up recording statistics of query %s', execution_id)
+
+
+@app.on_cw_event({
+    'source': ['aws.athena'],
+    'detail-type': ['Athena Query State Change'],
+    'detail': {
+        'currentState': ['SUCCEEDED', 'FAILED', 'CANCELLED'],
+        # Searches run in the default workgroup, which is all the role may
+        # read; queries in any other workgroup would only fail with AccessDenied
+        'workgroupName': ['primary']
+    }
+})
+def record_query_stats(event):
+    execution_id = event.detail['queryExecutionId']
+    athena = get_client('athena')
+    execution = athena.get_query_execution(QueryExecutionId=execution_id)['QueryExecution']
+
+    # Only searches started by /query and /query-delta are recorded
+    if execution.get('QueryExecutionContext', {}).get('Database') != ATHENA_DATABASE:
+        return
+    table = SQL_TABLE_RE.search(execution['Query'])
+    keyword = SQL_KEYWORD_RE.search(execution['Query'])
+    if table is None or keyword is None or table.group(1) not in [ATHENA_TABLE, ATHENA_DELTA_TABLE]:
+        return
+
+    state = execution['Status']['State']
+    statistics = execution.get('Statistics', {})
+    rows = None
+    if state == 'SUCCEEDED':
+        try:
+            res = athena.get_query_runtime_statistics(QueryExecutionId=execution_id)
+            rows = res['QueryRuntimeStatistics']['Rows']['OutputRows']
+        except (ClientError, KeyError) as ex:
+            app.log.warning('No runtime statistics for query %s: %s', execution_id, ex)
+
+    completed = execution['Status'].get('CompletionDateTime') or datetime.now(timezone.utc)
+    append_telemetry(completed.strftime('%Y-%m-%d'), execution_id, {
+        'id': execution_id,
+        'ts': completed.isoformat(),
+        'table': table.group(1),
+        'keyword': keyword.group(1),
+        'sources': SQL_SOURCE_RE.findall(execution['Query']),
+        'state': state,
+        'scanned': statistics.get('DataScannedInBytes', 0),
+        'engine_ms': statistics.get('EngineExecutionTimeInMillis', 0),
+        'queue_ms': statistics.get('QueryQueueTimeInMillis', 0),
+        'rows': rows
+    })
+
+
+def query_cost(scanned):
+    if not scanned:
+        return 0.0
+    billed = max(ATHENA_MIN_BILLED_BYTES, -(-scanned // (1024 * 1024)) * 1024 * 1024)
+    return billed / 1024 ** 4 * ATHENA_PRICE_PER_TB
+
+
+def add_query_stats(aggregate, record):
+    if not aggregate:
+        aggregate.update(queries=0, failed=0, bytes_scanned=0, engine_ms=0, queue_ms=0, rows=0, cost_usd=0.0)
+    aggregate['queries'] += 1
+    if record['state'] != 'SUCCEEDED':
+        aggregate['failed'] += 1
+    aggregate['bytes_scanned'] += record['scanned']
+    aggregate['engine_ms'] += record['engine_ms']
+    aggregate['queue_ms'] += record['queue_ms']
+    aggregate['rows'] += record['rows'] or 0
+    aggregate['cost_usd'] += query_cost(record['scanned'])
+
+
+def finish_query_stats(aggregate):
+    aggregate['avg_engine_ms'] = round(aggregate['engine_ms'] / aggregate['queries'], 2)
+    aggregate['avg_queue_ms'] = round(aggregate['queue_ms'] / aggregate['queries'], 2)
+    aggregate['cost_usd'] = round(aggregate['cost_usd'], 6)
+    return aggregate
+
+
+@app.route('/stats', methods=['GET'], cors=True)
+def stats():
+    params = app.current_request.query_params or {}
+    try:
+        days = max(1, int(params.get('days', TELEMETRY_DAYS)))
+    except ValueError:
+        raise BadRequestError('"days" query parameter must be a number')
+
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    total = {}
+    by_keyword = {}
+    by_source = {}
+
+    # Day logs sort by date, so listing can start at the first day of interest
+    s3 = get_client('s3')
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ATHENA_BUCKET, Prefix=TELEMETRY_PREFIX, StartAfter=f"{TELEMETRY_PREFIX}{since}"):
+        for obj in page.get('Contents', []):
+            body = s3.get_object(Bucket=ATHENA_BUCKET, Key=obj['Key'])['Body'].read()
+            for line in body.splitlines():
+                record = json.loads(line)
+                add_query_stats(total, record)
+                add_query_stats(by_keyword.setdefault(record['keyword'], {}), record)
+                for source in record['sources']:
+                    add_query_stats(by_source.setdefault(source, {}), record)
+
+    return json.dumps({
+        'since': since,
+        'total': finish_query_stats(total) if total else None,
+        'by_keyword': {keyword: finish_query_stats(agg) for keyword, agg in by_keyword.items()},
+        'by_source': {source: finish_query_stats(agg) for source, agg in by_source.items()}
+    })
+
+
 @app.route('/retrieve/{execution_id}', methods=['GET'], cors=True)
 def retrieve(execution_id):
     if execution_id in ['', None]:
         raise BadRequestError('Missing execution_id parameter')
     
-    athena = boto3.client('athena')
-    s3 = boto3.client('s3')
+    athena = get_client('athena')
+    s3 = get_client('s3')
 
     res = athena.get_query_execution(QueryExecutionId=execution_id)
     path = res['QueryExecution']['ResultConfiguration']['OutputLocation']
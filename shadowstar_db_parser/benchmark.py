@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks the hot paths of parser.py and cidr_reduce.py against synthetic data
+produced by gen_dumps.py. For each stage it reports the best wall clock time,
+the throughput and the peak Python heap usage (measured with tracemalloc in a
+separate run so that tracing does not skew the timings).
+
+Suggested usage:
+    python3 benchmark.py -n 100000
+    python3 benchmark.py -d ./bench_databases --repeat 5
+'''
+
+import os
+import gc
+import csv
+import sys
+import time
+import tempfile
+import argparse
+import contextlib
+import tracemalloc
+import importlib.util
+
+import gen_dumps
+import cidr_reduce
+
+
+def load_parser():
+    # Load parser.py by path, "import parser" picks up the standard library
+    # module of the same name on older Python versions.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser.py')
+    spec = importlib.util.spec_from_file_location('shadowstar_parser', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(func, repeat):
+    '''
+    Returns (best elapsed seconds, peak traced bytes, result of the last call)
+    '''
+    best = None
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def report(name, elapsed, peak, count, unit, size=None):
+    line = f"{name:<18} {elapsed:>9.3f} s {count / elapsed:>14,.0f} {unit}/s"
+    if size is not None:
+        line += f" {size / elapsed / 1024 / 1024:>9.1f} MB/s"
+    else:
+        line += ' ' * 15
+    line += f" {peak / 1024 / 1024:>10.1f} MB peak"
+    print(line)
+
+
+def main(database_dir, repeat, output_tsv, decompressor):
+    parser = load_parser()
+    parser.DECOMPRESSOR = decompressor
+    dumps = [name for name in parser.FILELIST if os.path.exists(os.path.join(database_dir, name))]
+    if not dumps:
+        print(f"No dumps found in {database_dir}")
+        sys.exit(1)
+
+    paths = [os.path.join(database_dir, name) for name in dumps]
+    total_size = sum(os.path.getsize(path) for path in paths)
+
+    print(f"decompressor: {parser.resolve_decompressor(decompressor)}")
+    print(f"{'stage':<18} {'time':>11} {'throughput':>23} {'':>14} {'memory':>15}")
+
+    # read_blocks
+    def run_read_blocks():
+        return [parser.read_blocks(path) for path in paths]
+    elapsed, peak, all_blocks = measure(run_read_blocks, repeat)
+    num_blocks = sum(len(blocks) for blocks in all_blocks)
+    report('read_blocks', elapsed, peak, num_blocks, 'blocks', total_size)
+
+    # parse_blocks; ARIN Org objects must be parsed before the Net objects
+    # that reference them, so the dumps are processed in FILELIST order.
+    def run_parse_blocks():
+        parser.reset_state()
+        with open(output_tsv, 'w') as handle:
+            writer = csv.writer(handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+            for name, blocks in zip(dumps, all_blocks):
+                parser.parse_blocks(blocks, writer, parser.get_source(name))
+            parser.write_route_sets(writer)
+        return parser.TOTAL_BLOCK_COUNT
+    elapsed, peak, num_rows = measure(run_parse_blocks, repeat)
+    report('parse_blocks', elapsed, peak, num_blocks, 'blocks')
+    report('  (rows written)', elapsed, peak, num_rows, 'rows')
+
+    # range_to_cidr
+    texts = [block.decode('utf-8', 'ignore') for blocks in all_blocks for block in blocks]
+    ranges = []
+    for text in texts:
+        inetnum = parser.parse_property(text, 'inetnum') or parser.parse_property(text, 'NetRange')
+        if inetnum and '-' in inetnum:
+            ranges.append(inetnum)
+    elapsed, peak, _ = measure(lambda: [parser.range_to_cidr(r) for r in ranges], repeat)
+    report('range_to_cidr', elapsed, peak, len(ranges), 'calls')
+
+    # parse_property
+    def run_parse_property():
+        for text in texts:
+            parser.parse_property(text, 'netname')
+            parser.parse_property(text, 'mnt-by')
+    elapsed, peak, _ = measure(run_parse_property, repeat)
+    report('parse_property', elapsed, peak, 2 * len(texts), 'calls')
+
+    del all_blocks, texts, ranges
+
+    # cidr_reduce.main; only feed it CIDR rows, the same as a keyword grep of
+    # the real TSV would.
+    reduce_input = output_tsv + '.cidr'
+    num_reduce_rows = 0
+    with open(output_tsv, 'r') as src, open(reduce_input, 'w') as dst:
+        for line in src:
+            inetnum = line.split('\t', 1)[0]
+            if '/' in inetnum and ('.' in inetnum or inetnum.count(':') > 1):
+                dst.write(line)
+                num_reduce_rows += 1
+
+    def run_cidr_reduce():
+        argv = sys.argv
+        sys.argv = ['cidr_reduce.py', reduce_input]
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                cidr_reduce.main()
+        finally:
+            sys.argv = argv
+    elapsed, peak, _ = measure(run_cidr_reduce, repeat)
+    report('cidr_reduce.main', elapsed, peak, num_reduce_rows, 'rows')
+    os.remove(reduce_input)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the SHADOWSTAR parser and reducer')
+    parser.add_argument('-d', dest='database_dir', type=str, help="Directory of dumps (default: generate synthetic dumps)")
+    parser.add_argument('-n', dest='num_blocks', type=int, default=20000, help="Objects per generated dump")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for generated dumps")
+    parser.add_argument('--decompressor', type=str, default='auto', help="gzip decompression backend passed to parser.py")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage, the best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='shadowstar_bench_') as tmp:
+        database_dir = args.database_dir
+        if database_dir is None:
+            database_dir = os.path.join(tmp, 'databases')
+            print(f"Generating synthetic dumps ({args.num_blocks} objects per dump)...")
+            gen_dumps.generate(database_dir, args.num_blocks, args.seed)
+        main(database_dir, max(1, args.repeat), os.path.join(tmp, 'network_info.tsv'), args.decompressor)
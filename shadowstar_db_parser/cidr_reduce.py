@@ -55,13 +55,15 @@ def mask_to_span(start, mask):
     return pow(2, 32-mask)
 
 
-def main():
-    rows = []
+def reduce_rows(rows):
+    '''
+    Returns the rows (lists of TSV fields, the CIDR block first) whose blocks
+    form the minimal spanning set of all of them
+    '''
     masks = {}
-
-    # Read in data from stdin
-    for line in fileinput.input():
-        rows.append(line.split('\t'))
+    reduced = []
+    if not rows:
+        return reduced
 
     # Convert all CIDR blocks into integers, sort them into ascending order
     augmented_rows = sorted([ip_to_int(row) for row in rows])
@@ -80,13 +82,25 @@ def main():
     while idx < len(augmented_rows)-1:
         idx += 1
         if start + span <= augmented_rows[idx][0]:
-            sys.stdout.write('\t'.join(augmented_rows[start_idx][1:]))
+            reduced.append(augmented_rows[start_idx][1:])
             if idx < len(augmented_rows):
                 start_idx = idx
                 start = augmented_rows[start_idx][0]
                 span = mask_to_span(start, masks[start])
 
-    sys.stdout.write('\t'.join(augmented_rows[start_idx][1:]))
+    reduced.append(augmented_rows[start_idx][1:])
+    return reduced
+
+
+def main():
+    rows = []
+
+    # Read in data from stdin
+    for line in fileinput.input():
+        rows.append(line.split('\t'))
+
+    for row in reduce_rows(rows):
+        sys.stdout.write('\t'.join(row))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+'''
+Computes the difference between two builds of the TSV file generated with the
+parser.py script. Both files are sorted (externally, in bounded memory, if they
+are not already) into temporary files and then merged in a single pass, so only
+the rows of one network block are ever held in memory at a time. The input
+files are left as they are.
+
+Rows are matched on (inetnum, source). A block can hold several rows, e.g. the
+route-sets covering a prefix or the origins of a route, which are compared as
+a multiset of owners. The delta file has the same columns as the TSV file with
+an extra leading column describing the change:
+
+    added       the row only exists in the new build
+    removed     the row only existed in the previous build
+    modified    the block has a single row in both builds but its owner
+                changed, this is the new row
+    previous    the old row of a modified block
+
+The counts reported are of blocks rather than rows; a block which both gained
+and lost rows counts as added and as removed.
+
+Suggested usage:
+    python3 delta.py old_network_info.tsv network_info.tsv -o delta.tsv
+'''
+
+import os
+import sys
+import heapq
+import argparse
+import tempfile
+import itertools
+import collections
+
+from contextlib import ExitStack
+
+
+# Roughly 150 MB of lines per in-memory run of the external sort
+SORT_CHUNK_LINES = 1000000
+
+# netname, description, country, maintained_by; a change in any of these is
+# a change of owner. Timestamps alone are not reported.
+OWNER_COLUMNS = (1, 2, 3, 4)
+SOURCE_COLUMN = 7
+
+CHANGES = ['added', 'removed', 'modified', 'previous']
+
+
+def sort_tsv(path: str, output_path: str = None, chunk_lines: int = SORT_CHUNK_LINES):
+    '''
+    Sorts the lines of a TSV file into output_path, or in place if it is not
+    given. Runs of chunk_lines lines are sorted in memory and written to
+    temporary files which are then k-way merged.
+    '''
+    directory = os.path.dirname(os.path.abspath(output_path or path))
+    runs = []
+    try:
+        with open(path, 'rb') as handle:
+            while True:
+                lines = list(itertools.islice(handle, chunk_lines))
+                if not lines:
+                    break
+                if not lines[-1].endswith(b'\n'):
+                    lines[-1] += b'\n'
+                lines.sort()
+                fd, run = tempfile.mkstemp(prefix='.sort_', dir=directory)
+                runs.append(run)
+                with os.fdopen(fd, 'wb') as out:
+                    out.writelines(lines)
+                del lines
+
+        fd, merged = tempfile.mkstemp(prefix='.sort_', dir=directory)
+        runs.append(merged)
+        with ExitStack() as stack, os.fdopen(fd, 'wb') as out:
+            inputs = [stack.enter_context(open(run, 'rb')) for run in runs[:-1]]
+            out.writelines(heapq.merge(*inputs))
+        os.replace(merged, output_path or path)
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+
+def is_sorted(path: str) -> bool:
+    previous = b''
+    with open(path, 'rb') as handle:
+        for line in handle:
+            if line < previous:
+                return False
+            previous = line
+    return True
+
+
+def read_groups(path: str):
+    '''
+    Yields (inetnum, [lines]) for each network block of a sorted TSV file.
+    Sorting whole lines sorts by inetnum first since tab sorts before every
+    printable character.
+    '''
+    previous = None
+    with open(path, 'rb') as handle:
+        for inetnum, lines in itertools.groupby(handle, key=lambda line: line.split(b'\t', 1)[0]):
+            if previous is not None and inetnum < previous:
+                raise ValueError(f"{path} is not sorted")
+            previous = inetnum
+            yield inetnum, list(lines)
+
+
+def by_source(lines: list) -> dict:
+    ret = {}
+    for line in lines:
+        fields = line.rstrip(b'\r\n').split(b'\t')
+        source = fields[SOURCE_COLUMN] if len(fields) > SOURCE_COLUMN else b''
+        owner = tuple(fields[i] for i in OWNER_COLUMNS if i < len(fields))
+        entry = ret.setdefault(source, ([], []))
+        entry[0].append(line)
+        entry[1].append(owner)
+    return ret
+
+
+def unmatched(lines: list, owners: list, others: list) -> list:
+    # The lines whose owner is not in others, counting duplicates
+    remaining = collections.Counter(others)
+    ret = []
+    for line, owner in zip(lines, owners):
+        if remaining[owner] > 0:
+            remaining[owner] -= 1
+        else:
+            ret.append(line)
+    return ret
+
+
+def diff_block(old: tuple, new: tuple):
+    '''
+    Yields (change, lines) for the rows of a single (inetnum, source) block
+    present in both builds; old and new are (lines, owners) from by_source().
+    '''
+    (old_lines, old_owners), (new_lines, new_owners) = old, new
+    if len(old_lines) == 1 and len(new_lines) == 1:
+        if old_owners != new_owners:
+            yield 'modified', new_lines
+            yield 'previous', old_lines
+        return
+
+    added = unmatched(new_lines, new_owners, old_owners)
+    removed = unmatched(old_lines, old_owners, new_owners)
+    if added:
+        yield 'added', added
+    if removed:
+        yield 'removed', removed
+
+
+def diff_group(old_lines: list, new_lines: list):
+    '''
+    Yields (change, lines) per source for a single network block
+    '''
+    old = by_source(old_lines)
+    new = by_source(new_lines)
+    for source, entry in new.items():
+        if source not in old:
+            yield 'added', entry[0]
+        else:
+            yield from diff_block(old[source], entry)
+    for source, entry in old.items():
+        if source not in new:
+            yield 'removed', entry[0]
+
+
+def merge_diff(old_path: str, new_path: str):
+    '''
+    Yields (change, lines) for every (inetnum, source) block which differs
+    between two sorted TSV files
+    '''
+    sentinel = (None, None)
+    old_groups = read_groups(old_path)
+    new_groups = read_groups(new_path)
+    old_key, old_lines = next(old_groups, sentinel)
+    new_key, new_lines = next(new_groups, sentinel)
+
+    while old_key is not None or new_key is not None:
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield from diff_group(old_lines, [])
+            old_key, old_lines = next(old_groups, sentinel)
+        elif old_key is None or new_key < old_key:
+            yield from diff_group([], new_lines)
+            new_key, new_lines = next(new_groups, sentinel)
+        else:
+            yield from diff_group(old_lines, new_lines)
+            old_key, old_lines = next(old_groups, sentinel)
+            new_key, new_lines = next(new_groups, sentinel)
+
+
+def compute_delta(old_path: str, new_path: str, delta_path: str, sort_new_in_place: bool = False) -> dict:
+    '''
+    Writes the delta between two builds to delta_path and returns the number
+    of blocks per change type. Unsorted inputs are sorted into temporary files
+    next to them; with sort_new_in_place the new build is sorted in place
+    instead, which saves a copy of it when it is about to be replaced anyway.
+    '''
+    temporary = []
+    try:
+        paths = []
+        for path, in_place in [(old_path, False), (new_path, sort_new_in_place)]:
+            if not is_sorted(path):
+                if in_place:
+                    sort_tsv(path)
+                else:
+                    fd, sorted_path = tempfile.mkstemp(prefix='.sorted_', dir=os.path.dirname(os.path.abspath(path)))
+                    os.close(fd)
+                    temporary.append(sorted_path)
+                    sort_tsv(path, sorted_path)
+                    path = sorted_path
+            paths.append(path)
+
+        counts = dict.fromkeys(CHANGES, 0)
+        with open(delta_path, 'wb') as out:
+            for change, lines in merge_diff(*paths):
+                counts[change] += 1
+                for line in lines:
+                    out.write(change.encode() + b'\t' + line)
+        return counts
+    finally:
+        for path in temporary:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the delta between two TSV builds')
+    parser.add_argument('old', type=str, help="TSV file of the previous build")
+    parser.add_argument('new', type=str, help="TSV file of the new build")
+    parser.add_argument('-o', dest='output_file', type=str, required=True, help="Output delta TSV file")
+    args = parser.parse_args()
+
+    counts = compute_delta(args.old, args.new, args.output_file)
+    for change in CHANGES:
+        sys.stderr.write(f"{change}: {counts[change]}\n")
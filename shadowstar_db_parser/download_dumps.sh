@@ -13,45 +13,63 @@ function download {
   wget -O "$DOWNLOAD_DIR/$name" "$1"
 }
 
+# Sources to download (ex: "ripe apnic") may be given as arguments, every
+# source is downloaded by default.
+SOURCES="$*"
+
+function wanted {
+  if [ -z "$SOURCES" ]; then
+    return 0
+  fi
+  for source in $SOURCES; do
+    if [ "$source" == "$1" ]; then
+      return 0
+    fi
+  done
+  return 1
+}
+
 # AfriNIC
-download "https://ftp.afrinic.net/pub/dbase/afrinic.db.gz"
+wanted afrinic && download "https://ftp.afrinic.net/pub/dbase/afrinic.db.gz"
 
 # APNIC
-download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.inetnum.gz"
-download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.inet6num.gz"
-download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route-set.gz"
-download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route.gz"
-download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route6.gz"
+wanted apnic && download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.inetnum.gz"
+wanted apnic && download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.inet6num.gz"
+wanted apnic && download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route-set.gz"
+wanted apnic && download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route.gz"
+wanted apnic && download "https://ftp.apnic.net/pub/apnic/whois/apnic.db.route6.gz"
 
 # LACNIC; NOTE: These files have the same name hence the second argument
-download "https://ftp.lacnic.net/lacnic/dbase/lacnic.db.gz"
-download "https://ftp.lacnic.net/lacnic/irr/lacnic.db.gz" "lacnic_irr.db.gz"
+wanted lacnic && download "https://ftp.lacnic.net/lacnic/dbase/lacnic.db.gz"
+wanted lacnic && download "https://ftp.lacnic.net/lacnic/irr/lacnic.db.gz" "lacnic_irr.db.gz"
 
 # RIPE-NCC
-download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.inetnum.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.inet6num.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route-set.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route6.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe-nonauth.db.route.gz"
-download "https://ftp.ripe.net/ripe/dbase/split/ripe-nonauth.db.route6.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.inetnum.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.inet6num.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route-set.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe.db.route6.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe-nonauth.db.route.gz"
+wanted ripe && download "https://ftp.ripe.net/ripe/dbase/split/ripe-nonauth.db.route6.gz"
 
 # http://irr.net/docs/list.html you should check that list periodically, it is
 # updated with important changes; IDNIC should work but they only allow
 # streaming FTP, not passive mode, so it's annoying to get it to work.
-download "https://ftp.arin.net/pub/rr/arin.db.gz"
-download "https://ftp.arin.net/pub/rr/arin-nonauth.db.gz"
-download "https://ftp.apnic.net/apnic/whois-data/JPIRR/jpirr.db.gz"
-download "ftp://rr.level3.net/pub/rr/level3.db.gz"
-download "ftp://rr1.ntt.net/nttcomRR/nttcom.db.gz"
-download "ftp://ftp.radb.net/radb/dbase/radb.db.gz"
-download "ftp://ftp.bgp.net.br/tc.db.gz"
-download "ftp://ftp.bgp.net.br/reach.db.gz"
-download "ftp://ftp.bgp.net.br/wcgdb.db.gz"
+wanted arin && download "https://ftp.arin.net/pub/rr/arin.db.gz"
+wanted arin && download "https://ftp.arin.net/pub/rr/arin-nonauth.db.gz"
+wanted jpirr && download "https://ftp.apnic.net/apnic/whois-data/JPIRR/jpirr.db.gz"
+wanted level3 && download "ftp://rr.level3.net/pub/rr/level3.db.gz"
+wanted nttcom && download "ftp://rr1.ntt.net/nttcomRR/nttcom.db.gz"
+wanted radb && download "ftp://ftp.radb.net/radb/dbase/radb.db.gz"
+wanted tc && download "ftp://ftp.bgp.net.br/tc.db.gz"
+wanted reach && download "ftp://ftp.bgp.net.br/reach.db.gz"
+wanted wcgdb && download "ftp://ftp.bgp.net.br/wcgdb.db.gz"
 
 # If you have a valid API key from ARIN, then you can download the full WHOIS 
 # database dump. Use "export ARIN_API_KEY=<KEY>" before running this script.
-if [[ ! -v ARIN_API_KEY ]]; then
+if ! wanted arin; then
+  exit
+elif [[ ! -v ARIN_API_KEY ]]; then
   exit
 elif [ -z "$ARIN_API_KEY" ]; then
   exit
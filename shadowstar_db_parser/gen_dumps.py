@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+'''
+Generates deterministic synthetic data dumps for benchmarking the parser. The
+dumps mimic the real RIR/IRR files closely enough to exercise every code path
+in parser.py: gzip compressed RPSL dumps containing inetnum, inet6num, route,
+route6 and route-set objects, and an uncompressed ARIN bulk WHOIS file with Org
+and Net objects.
+
+The same seed and size always produce byte-identical files, so results from two
+benchmark runs can be compared directly.
+
+Suggested usage:
+    python3 gen_dumps.py -o ./bench_databases -n 100000
+'''
+
+import os
+import gzip
+import random
+import ipaddress
+import argparse
+
+
+# Low cardinality values are drawn from small pools, just like the real dumps
+# where a handful of maintainers and countries cover millions of objects.
+COUNTRIES = [
+    'US', 'DE', 'GB', 'FR', 'NL', 'JP', 'CN', 'BR', 'AU', 'IN', 'ZA', 'RU',
+    'IT', 'ES', 'SE', 'KR', 'CA', 'MX', 'AR', 'NG'
+]
+WORDS = [
+    'acme', 'global', 'networks', 'telecom', 'hosting', 'cloud', 'data',
+    'systems', 'broadband', 'internet', 'services', 'solutions', 'digital',
+    'fiber', 'transit', 'backbone', 'university', 'bank', 'energy', 'media'
+]
+STATUSES = ['ASSIGNED PA', 'ALLOCATED PA', 'ASSIGNED PI', 'SUB-ALLOCATED PA']
+
+# Dump name -> (object type, source, relative size)
+RPSL_DUMPS = {
+    'afrinic.db.gz': ('mixed', 'AFRINIC', 0.2),
+    'apnic.db.inetnum.gz': ('inetnum', 'APNIC', 1.0),
+    'apnic.db.inet6num.gz': ('inet6num', 'APNIC', 0.5),
+    'apnic.db.route.gz': ('route', 'APNIC', 0.5),
+    'apnic.db.route6.gz': ('route6', 'APNIC', 0.2),
+    'apnic.db.route-set.gz': ('route-set', 'APNIC', 0.02),
+    'ripe.db.inetnum.gz': ('inetnum', 'RIPE', 1.0),
+    'ripe.db.inet6num.gz': ('inet6num', 'RIPE', 0.5),
+    'ripe.db.route.gz': ('route', 'RIPE', 0.5),
+    'ripe.db.route6.gz': ('route6', 'RIPE', 0.2),
+    'ripe.db.route-set.gz': ('route-set', 'RIPE', 0.02),
+    'radb.db.gz': ('mixed', 'RADB', 0.5),
+}
+ARIN_DUMP = 'arin_db.txt'
+MIXED_TYPES = ['inetnum', 'inet6num', 'route', 'route6', 'route-set']
+MIXED_WEIGHTS = [40, 20, 25, 10, 5]
+
+
+def rpsl_attr(name, value):
+    return f"{name + ':':<16}{value}\n"
+
+
+def ipv4(value):
+    return '.'.join(str((value >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def random_ipv4_prefix(rng):
+    mask = rng.randint(16, 28)
+    start = rng.randint(0x01000000, 0xdfffffff) & ~((1 << (32 - mask)) - 1)
+    return start, mask
+
+
+def random_ipv6_prefix(rng):
+    mask = rng.choice([29, 32, 36, 40, 44, 48])
+    value = (0x2001 << 112) | (rng.getrandbits(32) << 80)
+    value &= ~((1 << (128 - mask)) - 1)
+    return str(ipaddress.IPv6Network((value, mask)))
+
+
+def random_date(rng):
+    return f"{rng.randint(1995, 2021)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def random_name(rng, count=2):
+    return '-'.join(rng.choice(WORDS) for _ in range(count)).upper()
+
+
+def random_maintainer(rng):
+    return f"MAINT-{rng.choice(WORDS).upper()}{rng.randint(1, 500)}"
+
+
+def rpsl_common(rng, source):
+    date = random_date(rng)
+    text = ''
+    for _ in range(rng.randint(1, 3)):
+        text += rpsl_attr('descr', f"{random_name(rng, 3).title()} {rng.choice(WORDS).title()}")
+    text += rpsl_attr('admin-c', f"AC{rng.randint(1, 9999)}-{source}")
+    text += rpsl_attr('tech-c', f"TC{rng.randint(1, 9999)}-{source}")
+    text += rpsl_attr('mnt-by', random_maintainer(rng))
+    text += rpsl_attr('created', f"{date}T00:00:00Z")
+    text += rpsl_attr('last-modified', f"{random_date(rng)}T00:00:00Z")
+    text += rpsl_attr('source', source)
+    return text
+
+
+def rpsl_object(rng, kind, source, route_sets):
+    if kind == 'inetnum':
+        start, mask = random_ipv4_prefix(rng)
+        end = start + (1 << (32 - mask)) - 1
+        text = rpsl_attr('inetnum', f"{ipv4(start)} - {ipv4(end)}")
+        text += rpsl_attr('netname', random_name(rng))
+        text += rpsl_attr('country', rng.choice(COUNTRIES))
+        text += rpsl_attr('status', rng.choice(STATUSES))
+    elif kind == 'inet6num':
+        text = rpsl_attr('inet6num', random_ipv6_prefix(rng))
+        text += rpsl_attr('netname', random_name(rng))
+        text += rpsl_attr('country', rng.choice(COUNTRIES))
+        text += rpsl_attr('status', 'ALLOCATED-BY-RIR')
+    elif kind == 'route':
+        start, mask = random_ipv4_prefix(rng)
+        text = rpsl_attr('route', f"{ipv4(start)}/{mask}")
+        text += rpsl_attr('origin', f"AS{rng.randint(1, 400000)}")
+    elif kind == 'route6':
+        text = rpsl_attr('route6', random_ipv6_prefix(rng))
+        text += rpsl_attr('origin', f"AS{rng.randint(1, 400000)}")
+    else:
+        name = f"RS-{random_name(rng)}-{len(route_sets)}"
+        members = []
+        for _ in range(rng.randint(1, 8)):
+            start, mask = random_ipv4_prefix(rng)
+            members.append(f"{ipv4(start)}/{mask}")
+        # Nested route-set and AS number members, which is what makes route-set
+        # resolution non-trivial in the real dumps.
+        if route_sets:
+            members.extend(rng.sample(route_sets, min(len(route_sets), rng.randint(0, 3))))
+        if rng.random() < 0.3:
+            members.append(f"AS{rng.randint(1, 400000)}")
+        route_sets.append(name)
+        text = rpsl_attr('route-set', name)
+        text += rpsl_attr('members', ', '.join(members))
+        if rng.random() < 0.3:
+            text += rpsl_attr('mp-members', random_ipv6_prefix(rng))
+    return text + rpsl_common(rng, source)
+
+
+def write_rpsl_dump(path, kind, source, count, rng):
+    route_sets = []
+    # A fixed mtime keeps the gzip header, and so the whole file, reproducible
+    with gzip.GzipFile(path, 'wb', compresslevel=6, mtime=0) as handle:
+        handle.write(b'% This is a synthetic SHADOWSTAR benchmark dump\n')
+        handle.write(b'% It is not real registry data\n\n')
+        for _ in range(count):
+            if kind == 'mixed':
+                obj_kind = rng.choices(MIXED_TYPES, MIXED_WEIGHTS)[0]
+            else:
+                obj_kind = kind
+            handle.write(rpsl_object(rng, obj_kind, source, route_sets).encode())
+            handle.write(b'\n')
+
+
+def write_arin_dump(path, count, rng):
+    num_orgs = max(1, count // 10)
+    with open(path, 'wb') as handle:
+        handle.write(b'# This is a synthetic SHADOWSTAR benchmark dump\n\n')
+        # Org objects have to come first, parse_blocks looks them up by OrgID
+        # when it encounters a Net object.
+        for i in range(num_orgs):
+            text = f"OrgID:          ORG{i}-ARIN\n"
+            text += f"OrgName:        {random_name(rng, 3).title()}\n"
+            text += f"Street:         {rng.randint(1, 9999)} {rng.choice(WORDS).title()} St\n"
+            text += f"City:           {rng.choice(WORDS).title()}\n"
+            text += f"Country:        {rng.choice(COUNTRIES)}\n"
+            text += f"RegDate:        {random_date(rng)}\n"
+            text += f"Updated:        {random_date(rng)}\n"
+            handle.write(text.encode() + b'\n')
+        for i in range(count):
+            if rng.random() < 0.8:
+                start, mask = random_ipv4_prefix(rng)
+                end = start + (1 << (32 - mask)) - 1
+                text = f"NetHandle:      NET-{ipv4(start).replace('.', '-')}-{i}\n"
+                text += f"NetRange:       {ipv4(start)} - {ipv4(end)}\n"
+            else:
+                prefix = random_ipv6_prefix(rng).split('/')[0]
+                text = f"V6NetHandle:    NET6-{prefix.replace(':', '-')}{i}\n"
+                text += f"NetRange:       {prefix} - {prefix}ffff\n"
+            text += f"OrgID:          ORG{rng.randrange(num_orgs)}-ARIN\n"
+            text += f"NetName:        {random_name(rng)}\n"
+            text += "NetType:        Direct Allocation\n"
+            text += f"RegDate:        {random_date(rng)}\n"
+            text += f"Updated:        {random_date(rng)}\n"
+            handle.write(text.encode() + b'\n')
+
+
+def generate(output_dir, num_blocks, seed=0):
+    '''
+    Writes every synthetic dump into output_dir and returns the list of file
+    names that were created.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    created = []
+
+    # Every dump gets its own generator so that changing one dump does not
+    # shift the contents of all the others.
+    for i, (name, (kind, source, scale)) in enumerate(RPSL_DUMPS.items()):
+        rng = random.Random(seed * 1000 + i)
+        write_rpsl_dump(os.path.join(output_dir, name), kind, source,
+                        max(1, int(num_blocks * scale)), rng)
+        created.append(name)
+
+    rng = random.Random(seed * 1000 + len(RPSL_DUMPS))
+    write_arin_dump(os.path.join(output_dir, ARIN_DUMP), num_blocks, rng)
+    created.append(ARIN_DUMP)
+    return created
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic RPSL/ARIN dumps for benchmarking')
+    parser.add_argument('-o', dest='output_dir', type=str, default='./bench_databases', help="Output directory")
+    parser.add_argument('-n', dest='num_blocks', type=int, default=100000, help="Objects per full-size dump")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    for name in generate(args.output_dir, args.num_blocks, args.seed):
+        path = os.path.join(args.output_dir, name)
+        print(f"{path}\t{os.path.getsize(path)} bytes")
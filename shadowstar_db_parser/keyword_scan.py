@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+'''
+Searches the TSV file generated with the parser.py script for many keywords in
+a single pass. Instead of running grep once per keyword, every keyword is
+compiled into one Aho-Corasick automaton which is run over the netname,
+description and maintained_by fields of each row.
+
+Matching rows are written out unchanged with one extra trailing column listing
+the keywords which matched, so the output can be piped straight into the
+cidr_reduce.py script.
+
+Keywords are read from a file, one per line; blank lines and lines starting
+with '#' are ignored. Matching is case-insensitive unless --case-sensitive is
+given. Keywords written for the web app may start or end with the % wildcard,
+any other wildcard is rejected since keywords are matched literally.
+
+Suggested usage:
+    python3 keyword_scan.py -f keywords.txt network_info.tsv | python3 cidr_reduce.py
+    grep -v '^#' keywords.txt | python3 keyword_scan.py -f - -s arin -s ripe network_info.tsv
+'''
+
+import sys
+import argparse
+import fileinput
+
+
+# netname, description, maintained_by
+SEARCH_COLUMNS = (1, 2, 4)
+SOURCE_COLUMN = 7
+
+# Joins the searched fields; it never appears in a keyword, so it sends the
+# automaton back to its root and no match can span two fields.
+FIELD_SEPARATOR = '\0'
+
+
+class KeywordAutomaton:
+    '''
+    Aho-Corasick automaton over a fixed list of keywords
+    '''
+
+    def __init__(self, keywords: list, case_sensitive: bool = False):
+        self.case_sensitive = case_sensitive
+        self.keywords = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _fold(self, text: str) -> str:
+        return text if self.case_sensitive else text.casefold()
+
+    def _add(self, keyword: str):
+        folded = self._fold(keyword)
+        if not folded or FIELD_SEPARATOR in folded or keyword in self.keywords:
+            return
+        self.keywords.append(keyword)
+
+        state = 0
+        for ch in folded:
+            if ch not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][ch] = len(self._goto) - 1
+            state = self._goto[state][ch]
+        self._output[state] += (len(self.keywords) - 1,)
+
+    def _build(self):
+        # Breadth-first so that the failure link of a state's parent is always
+        # complete before the state itself is processed.
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(ch, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def search(self, text: str) -> set:
+        '''
+        Returns the indices (into self.keywords) of every keyword in text
+        '''
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found = set()
+        state = 0
+        for ch in self._fold(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    def match_row(self, fields: list) -> list:
+        '''
+        Returns the keywords found in the searched columns of a TSV row, in the
+        order they were given.
+        '''
+        text = FIELD_SEPARATOR.join(fields[i] for i in SEARCH_COLUMNS if i < len(fields))
+        return [self.keywords[i] for i in sorted(self.search(text))]
+
+
+def strip_wildcards(keyword: str) -> str:
+    '''
+    Turns a keyword written for the web app, which searches with SQL LIKE, into
+    the literal substring it stands for. Only a leading or trailing % has a
+    literal equivalent; a ValueError is raised for any other wildcard, which
+    would otherwise be matched as a plain character and never match.
+    '''
+    keyword = keyword.strip('%')
+    if '%' in keyword or '_' in keyword:
+        raise ValueError(f"Keyword {keyword!r} uses a wildcard other than a leading or trailing %")
+    return keyword
+
+
+def load_keywords(handle) -> list:
+    keywords = []
+    for line in handle:
+        keyword = line.strip()
+        if not keyword or keyword.startswith('#'):
+            continue
+        keywords.append(strip_wildcards(keyword))
+    return keywords
+
+
+def main(keywords, files, sources, case_sensitive):
+    automaton = KeywordAutomaton(keywords, case_sensitive)
+    if not automaton.keywords:
+        sys.stderr.write('No keywords to search for\n')
+        sys.exit(1)
+
+    for line in fileinput.input(files=files):
+        fields = line.rstrip('\r\n').split('\t')
+        if sources and (len(fields) <= SOURCE_COLUMN or fields[SOURCE_COLUMN].lower() not in sources):
+            continue
+        matched = automaton.match_row(fields)
+        if matched:
+            sys.stdout.write('\t'.join(fields) + '\t' + ','.join(matched) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search a SHADOWSTAR TSV file for many keywords in one pass')
+    parser.add_argument('-f', dest='keyword_file', type=argparse.FileType('r'), required=True, help="File with one keyword per line ('-' for stdin)")
+    parser.add_argument('-s', dest='sources', action='append', default=[], help="Only search rows from this source (repeatable)")
+    parser.add_argument('--case-sensitive', action='store_true', help="Do not case-fold keywords and fields")
+    parser.add_argument('files', nargs='*', help="TSV files to search (default: stdin)")
+    args = parser.parse_args()
+
+    if args.keyword_file is sys.stdin and not args.files:
+        parser.error('the TSV file has to be given as an argument when keywords are read from stdin')
+
+    try:
+        keywords = load_keywords(args.keyword_file)
+    except ValueError as ex:
+        sys.stderr.write(f"{ex}\n")
+        sys.exit(1)
+    main(keywords, args.files, set(s.lower() for s in args.sources), args.case_sensitive)
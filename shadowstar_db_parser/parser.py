@@ -3,24 +3,35 @@
 
 # TODO: Make this more memory conservative 
 
+import io
 import os
 import re
 import csv
 import json
-import gzip
+import sys
 import time
+import zlib
+import shutil
 import os.path
 import logging
 import argparse
+import functools
+import collections
+import contextlib
 import subprocess as sp
 
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
 
 import boto3
 
-from netaddr import iprange_to_cidrs
+from botocore.exceptions import ClientError
+from netaddr import IPNetwork, AddrFormatError, iprange_to_cidrs
 from irrd.rpsl.rpsl_objects import rpsl_object_from_text
 
+from delta import compute_delta
+from watchlist import load_watchlists, WatchlistScanner
+
 
 # Optional ARIN configuration
 ARIN_API_KEY = os.environ.get('ARIN_API_KEY')
@@ -30,14 +41,65 @@ ARIN_SECRET_NAME = os.environ.get('ARIN_SECRET_NAME')
 S3_BUCKET = os.environ.get('S3_BUCKET')
 S3_PATH = os.environ.get('S3_PATH')
 S3_METADATA_PATH = os.environ.get('S3_METADATA_PATH')
+S3_DELTA_PATH = os.environ.get('S3_DELTA_PATH')
 SYSTEM_VERSION = os.environ.get('SYSTEM_VERSION')
 
+# Optional S3 configuration for per-source update tasks; each task uploads its
+# part below this prefix and the merge step collects them from there.
+S3_PARTS_PREFIX = os.environ.get('S3_PARTS_PREFIX')
+
+# Optional S3 configuration for watchlists; definitions are read from the first
+# prefix and the results of each one are written below the second.
+S3_WATCHLIST_PREFIX = os.environ.get('S3_WATCHLIST_PREFIX')
+S3_WATCHLIST_RESULTS_PREFIX = os.environ.get('S3_WATCHLIST_RESULTS_PREFIX')
+
+# Optional decompression configuration; one of 'auto' or DECOMPRESSORS
+DECOMPRESSOR = os.environ.get('DECOMPRESSOR', 'auto')
+
 
 TOTAL_BLOCK_COUNT = 0
 ARIN_ORGS = {}
 CURRENT_FILENAME = "empty"
+PARTS_DIR = './parts'
+
+# With --checkpoint every dump is parsed into a shard of its own and the
+# progress is recorded every CHECKPOINT_BLOCKS blocks, see parse_dumps()
+CHECKPOINT_DIR = './checkpoint'
+CHECKPOINT_BLOCKS = 100000
+
+# Watchlists are evaluated against every row as the final TSV file is written,
+# see copy_rows()
+WATCHLISTS = None
+WATCHLIST_DIR = './watchlists'
+WATCHLIST_RESULTS_DIR = './watchlist-results'
+
+# (source, route-set name) -> (prefix members, nested route-set members); the
+# sets are collected from every dump and expanded once all of them have been
+# read. Mirrors such as RADB carry their own, possibly stale, copies of the
+# route-sets of other registries, hence the source is part of the key.
+ROUTE_SETS = {}
+ROUTE_SET_ROWS = []
+ROUTE_SET_CACHE = {}
+
+# One output row; a tuple is a single allocation with no spare capacity, which
+# matters for rows that are buffered (route-sets) rather than written directly.
+NetworkRow = collections.namedtuple('NetworkRow', [
+    'inetnum', 'netname', 'description', 'country', 'maintained_by',
+    'created', 'last_modified', 'source'
+])
+
+STRING_CACHE = {}
+
+CIDR_JUNK_RE = re.compile(r'[^0-9a-fA-F\:\.\/]')
 VERSION = '2.0'
 
+# Ordered fastest first, 'auto' picks the first one which is installed. igzip
+# (ISA-L) and pigz run in a separate process so decompression overlaps with
+# parsing; zlib is always available.
+DECOMPRESSORS = ['igzip', 'pigz', 'zlib']
+DECOMPRESS_BUFFER_SIZE = 4 * 1024 * 1024
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
 FILELIST = [
     'arin_db.txt',
 
@@ -79,36 +141,41 @@ logging.basicConfig(
 logger = logging.getLogger('shadowstar_db_parser')
 
 
-def get_source(filename: str):
+def get_source(filename: str) -> str:
     if filename.startswith('afrinic'):
-        return b'afrinic'
+        return 'afrinic'
     elif filename.startswith('apnic'):
-        return b'apnic'
+        return 'apnic'
     elif filename.startswith('arin'):
-        return b'arin'
+        return 'arin'
     elif filename.startswith('lacnic'):
-        return b'lacnic'
+        return 'lacnic'
     elif filename.startswith('ripe'):
-        return b'ripe'
+        return 'ripe'
     elif filename.startswith('level3'):
-        return b'level3'
+        return 'level3'
     elif filename.startswith('nttcom'):
-        return b'nttcom'
+        return 'nttcom'
     elif filename.startswith('radb'):
-        return b'radb'
+        return 'radb'
     elif filename.startswith('tc'):
-        return b'tc'
+        return 'tc'
     elif filename.startswith('reach'):
-        return b'reach'
+        return 'reach'
     elif filename.startswith('wcgdb'):
-        return b'wcgdb'
+        return 'wcgdb'
     elif filename.startswith('jpirr'):
-        return b'jpirr'
+        return 'jpirr'
     else:
         logger.error(f"Can not determine source for {filename}")
     return None
 
 
+# Sources in FILELIST order. Each one can be parsed on its own, only route-sets
+# need every source and are resolved when the parts are merged.
+SOURCES = list(dict.fromkeys(get_source(entry) for entry in FILELIST))
+
+
 def parse_property(block: str, name: str) -> str:
     match = re.findall('^%s:\s?(.+)$' % (name), block, re.MULTILINE)
     if match:
@@ -139,54 +206,143 @@ def parse_arin_inetnum(block: str) -> str:
     return None
 
 
+class ZlibReader(io.RawIOBase):
+    '''
+    Decompresses a gzip file in large chunks. The gzip module only ever reads
+    8 KB at a time, which makes the per-call overhead noticeable on multi-GB
+    dumps. Concatenated gzip members are supported.
+    '''
+
+    def __init__(self, filename: str, chunk_size: int = DECOMPRESS_BUFFER_SIZE):
+        self._file = open(filename, 'rb')
+        self._chunk_size = chunk_size
+        self._inflater = zlib.decompressobj(GZIP_WBITS)
+        self._in_member = False
+        self._pending = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _inflate(self) -> bytes:
+        while True:
+            data = b''
+            if self._inflater.eof:
+                data = self._inflater.unused_data
+                self._inflater = zlib.decompressobj(GZIP_WBITS)
+                self._in_member = False
+            if not data:
+                data = self._file.read(self._chunk_size)
+                if not data:
+                    # Same as the gzip module; a partial download must not
+                    # be published as if it were the whole dump.
+                    if self._in_member and not self._inflater.eof:
+                        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {self._file.name}")
+                    return b''
+            self._in_member = True
+            out = self._inflater.decompress(data)
+            if out:
+                return out
+
+    def readinto(self, buffer) -> int:
+        if self._offset >= len(self._pending):
+            self._pending = self._inflate()
+            self._offset = 0
+        size = min(len(buffer), len(self._pending) - self._offset)
+        buffer[:size] = self._pending[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_decompressor(name: str) -> str:
+    if name == 'auto':
+        for candidate in DECOMPRESSORS:
+            if candidate == 'zlib' or shutil.which(candidate):
+                return candidate
+    if name not in DECOMPRESSORS:
+        raise ValueError(f"Unknown decompressor {name}")
+    if name != 'zlib' and not shutil.which(name):
+        logger.warning(f"Decompressor {name} is not installed, falling back to zlib")
+        return 'zlib'
+    return name
+
+
+@contextlib.contextmanager
+def open_dump(filename: str):
+    if not filename.endswith('.gz'):
+        with open(filename, mode='rb', buffering=DECOMPRESS_BUFFER_SIZE) as f:
+            yield f
+        return
+
+    decompressor = resolve_decompressor(DECOMPRESSOR)
+    logger.info(f"decompressing {filename} with {decompressor}")
+
+    if decompressor == 'zlib':
+        with io.BufferedReader(ZlibReader(filename), buffer_size=DECOMPRESS_BUFFER_SIZE) as f:
+            yield f
+        return
+
+    proc = sp.Popen([decompressor, '-d', '-c', filename], stdout=sp.PIPE, bufsize=DECOMPRESS_BUFFER_SIZE)
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise IOError(f"{decompressor} failed on {filename} with exit code {proc.returncode}")
+
+
 def read_blocks(filename: str) -> list:
-    if filename.endswith('.gz'):
-        openmethod = gzip.open
-    else:
-        openmethod = open
 
     # inetnum, inet6num, route, route-set, route6
-    rpsl_block_re = re.compile(r'^(inet|route).{0,5}:')
-    cust_source = get_source(filename.split('/')[-1])
-    single_block = b''
+    rpsl_block_re = re.compile(rb'^(inet|route).{0,5}:')
+    lines = []
     blocks = []
 
     # APNIC/LACNIC/RIPE/AFRINIC/IRR are all in RPSL
-    def is_rpsl_block_start(line: bytes):
-        line_str = line.decode('utf-8', 'ignore')
-        if rpsl_block_re.match(line_str):
+    def is_rpsl_block_start(block: bytes):
+        if rpsl_block_re.match(block):
             return True
         return False
 
     # ARIN's WHOIS database is in a custom format
-    def is_arin_block_start(line):
-        if line.startswith(b'NetHandle:'):
+    def is_arin_block_start(block: bytes):
+        if block.startswith(b'NetHandle:'):
             return True
-        elif line.startswith(b'V6NetHandle:'):
+        elif block.startswith(b'V6NetHandle:'):
             return True
-        elif line.startswith(b'OrgID:'):
+        elif block.startswith(b'OrgID:'):
             return True
         return False
 
-    with openmethod(filename, mode='rb') as f:
+    with open_dump(filename) as f:
         for line in f:
             # skip comments
             if line.startswith(b'%') or line.startswith(b'#'):
                 continue
             # block end
             if line.strip() == b'':
-                if is_rpsl_block_start(single_block) or is_arin_block_start(single_block):
-                    # add source
-                    single_block += b"cust_source: %s" % (cust_source)
-                    blocks.append(single_block)
-                    if len(blocks) % 1000 == 0:
-                        logger.debug(f"parsed another 1000 blocks ({len(blocks)} so far)")
-                    single_block = b''
-                else:
-                    single_block = b''
+                if lines:
+                    single_block = b''.join(lines)
+                    if is_rpsl_block_start(single_block) or is_arin_block_start(single_block):
+                        blocks.append(single_block)
+                        if len(blocks) % 1000 == 0:
+                            logger.debug(f"parsed another 1000 blocks ({len(blocks)} so far)")
+                    lines = []
             else:
-                single_block += line
-    
+                lines.append(line)
+
+    # The dump may not end with an empty line
+    if lines:
+        single_block = b''.join(lines)
+        if is_rpsl_block_start(single_block) or is_arin_block_start(single_block):
+            blocks.append(single_block)
+
     logger.info(f"Got {len(blocks)} blocks")
     return blocks
 
@@ -202,7 +358,131 @@ def range_to_cidr(inetnum):
         return inetnum
 
 
-def parse_blocks(blocks, csv_writer):
+def add_route_set(source: str, name: str, members: list):
+    prefixes, nested = ROUTE_SETS.setdefault((source.upper(), name.upper()), ([], []))
+    for member in members:
+        # Range operators (^+, ^-, ^n-m) only narrow down more-specifics, the
+        # covering prefix is what we are after.
+        member = str(member).split('^')[0].strip()
+        if '/' in member:
+            try:
+                prefixes.append(str(IPNetwork(member)))
+            except (AddrFormatError, ValueError):
+                logger.debug(f"Invalid prefix {member} in route-set {name}")
+        elif 'RS-' in member.upper():
+            nested.append(member.upper())
+        # AS numbers and as-sets would need the route origin index to expand,
+        # they do not name any prefixes by themselves.
+
+
+def resolve_route_sets():
+    '''
+    Expands every collected route-set into the prefixes it covers, following
+    nested route-set members. Route-sets which reference each other form a
+    strongly connected component whose members all expand to the same set of
+    prefixes, so the graph is walked with (an iterative) Tarjan's algorithm and
+    every component is expanded exactly once. Components are completed in
+    reverse topological order, which means every nested route-set outside the
+    current component is already in ROUTE_SET_CACHE.
+
+    A nested member is looked up in the source of the route-set naming it; only
+    when that source does not define it is it taken from another source, the
+    RIRs first in SOURCES order and then the remaining sources by name.
+    '''
+    rank = {source.upper(): i for i, source in enumerate(SOURCES)}
+    defined = {}
+    for source, name in ROUTE_SETS:
+        defined.setdefault(name, []).append(source)
+    for sources in defined.values():
+        sources.sort(key=lambda source: (rank.get(source, len(rank)), source))
+
+    edges = {}
+    for key, (_, nested) in ROUTE_SETS.items():
+        edges[key] = []
+        for name in nested:
+            if (key[0], name) in ROUTE_SETS:
+                edges[key].append((key[0], name))
+            elif name in defined:
+                edges[key].append((defined[name][0], name))
+
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+
+    def visit(name):
+        index[name] = lowlink[name] = len(index)
+        stack.append(name)
+        on_stack.add(name)
+        return (name, iter(edges[name]))
+
+    for root in ROUTE_SETS:
+        if root in index or root in ROUTE_SET_CACHE:
+            continue
+        work = [visit(root)]
+        while work:
+            name, children = work[-1]
+            for child in children:
+                if child in ROUTE_SET_CACHE:
+                    continue
+                if child not in index:
+                    work.append(visit(child))
+                    break
+                if child in on_stack:
+                    lowlink[name] = min(lowlink[name], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] != index[name]:
+                    continue
+
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == name:
+                        break
+                if len(component) > 1:
+                    logger.debug(f"route-set cycle: {', '.join(f'{source}:{name}' for source, name in component)}")
+
+                # dict keeps the first-seen order while dropping duplicates
+                prefixes = {}
+                for member in reversed(component):
+                    prefixes.update(dict.fromkeys(ROUTE_SETS[member][0]))
+                for member in reversed(component):
+                    for nested in edges[member]:
+                        if nested in ROUTE_SET_CACHE:
+                            prefixes.update(dict.fromkeys(ROUTE_SET_CACHE[nested]))
+                expanded = tuple(prefixes)
+                for member in component:
+                    ROUTE_SET_CACHE[member] = expanded
+
+
+def write_route_sets(csv_writer):
+    global TOTAL_BLOCK_COUNT
+    resolve_route_sets()
+    for row in ROUTE_SET_ROWS:
+        for prefix in ROUTE_SET_CACHE.get((row.source.upper(), row.netname.upper()), ()):
+            csv_writer.writerow(row._replace(inetnum=prefix))
+            if WATCHLISTS is not None:
+                WATCHLISTS.scan_fields(row._replace(inetnum=prefix))
+            TOTAL_BLOCK_COUNT += 1
+    logger.info(f"resolved {len(ROUTE_SET_ROWS)} route-set objects into {len(ROUTE_SET_CACHE)} unique route-sets")
+
+
+def intern(value):
+    # Country, maintainer and source values repeat millions of times; interning
+    # makes every repeat share a single string object. Unlike sys.intern the
+    # cache can be dropped once parsing is done.
+    if isinstance(value, str):
+        return STRING_CACHE.setdefault(value, value)
+    return value
+
+
+def parse_blocks(blocks, csv_writer, cust_source: str = None):
     global TOTAL_BLOCK_COUNT
     arin_customer_re = re.compile('^OrgID:')
     arin_network_re = re.compile('^(Net|V6Net)Handle:')
@@ -227,7 +507,7 @@ def parse_blocks(blocks, csv_writer):
             orgid = parse_property(b, 'OrgID')
             orgname = parse_property(b, 'OrgName')
             country = parse_property(b, 'Country')
-            ARIN_ORGS[orgid] = (orgname, country)
+            ARIN_ORGS[orgid] = (intern(orgname), intern(country))
             continue
 
         # ARIN's dump format is also not in RPSL for whatever reason. They
@@ -245,7 +525,7 @@ def parse_blocks(blocks, csv_writer):
             maintained_by = ARIN_ORGS[orgid][0]
             created = parse_property(b, 'RegDate')
             last_modified = parse_property(b, 'Updated')
-            source = parse_property(b, 'cust_source')
+            source = cust_source
 
         # All other data dumps are in RPSL so we can use a proper parser
         # provided by the irrd package
@@ -265,8 +545,8 @@ def parse_blocks(blocks, csv_writer):
                 if 'route-set' in rpsl_object.parsed_data:
                     netname = rpsl_object.parsed_data['route-set']
                     # Changes type from str -> list
-                    if 'members' in rpsl_object.parsed_data:
-                        inetnum = rpsl_object.parsed_data['members']
+                    inetnum = rpsl_object.parsed_data.get('members', []) + \
+                        rpsl_object.parsed_data.get('mp-members', [])
 
                 # Some of these might exist, or not, depends entirely on RIR/IRR
                 if 'netname' in rpsl_object.parsed_data:
@@ -288,73 +568,413 @@ def parse_blocks(blocks, csv_writer):
                 if 'source' in rpsl_object.parsed_data:
                     source = rpsl_object.parsed_data['source']
                 else:
-                    source = parse_property(b, 'cust_source')
+                    source = cust_source
             except Exception as ex:
                 logger.error(ex)
 
-        # See the above note regarding the route-set RPSL object
+        country = intern(country)
+        maintained_by = intern(maintained_by)
+        source = intern(source)
+
+        # See the above note regarding the route-set RPSL object; members can
+        # name other route-sets which may live in a different dump, so the
+        # rows are only written once every dump has been read.
         if isinstance(inetnum, list):
-            for cidr in inetnum:
-                c = re.sub(r'[^0-9a-fA-F\:\.\/]', '', str(cidr))
-                row = [c, netname, description, country, maintained_by, created, last_modified, source]
-                csv_writer.writerow(row)
-            TOTAL_BLOCK_COUNT += len(inetnum)
+            add_route_set(source, netname, inetnum)
+            ROUTE_SET_ROWS.append(NetworkRow(None, netname, description, country, maintained_by, created, last_modified, source))
         else:
             c = range_to_cidr(inetnum)
             if isinstance(c, list):
                 for sub in c:
-                    s = re.sub(r'[^0-9a-fA-F\:\.\/]', '', str(sub))
-                    row = [s, netname, description, country, maintained_by, created, last_modified, source]
-                    csv_writer.writerow(row)
+                    s = CIDR_JUNK_RE.sub('', str(sub))
+                    csv_writer.writerow(NetworkRow(s, netname, description, country, maintained_by, created, last_modified, source))
                 TOTAL_BLOCK_COUNT += len(c)
             else:
-                    s = re.sub(r'[^0-9a-fA-F\:\.\/]', '', str(c))
-                    row = [s, netname, description, country, maintained_by, created, last_modified, source]
-                    csv_writer.writerow(row)
+                    s = CIDR_JUNK_RE.sub('', str(c))
+                    csv_writer.writerow(NetworkRow(s, netname, description, country, maintained_by, created, last_modified, source))
                     TOTAL_BLOCK_COUNT += 1
 
 
-def main(output_file):
-    overall_start_time = time.time()
+def reset_state():
+    global TOTAL_BLOCK_COUNT
+    TOTAL_BLOCK_COUNT = 0
+    ARIN_ORGS.clear()
+    ROUTE_SETS.clear()
+    ROUTE_SET_ROWS.clear()
+    ROUTE_SET_CACHE.clear()
+    STRING_CACHE.clear()
 
-    with open(output_file, 'w') as output_file_handle:
-        csv_writer = csv.writer(output_file_handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
-        for entry in FILELIST:
-            global CURRENT_FILENAME
-            CURRENT_FILENAME = entry
-            f_name = f"./databases/{entry}"
 
-            if os.path.exists(f_name):
+def state_snapshot() -> dict:
+    # Everything that outlives a single dump: the row count and the
+    # route-sets, which are only written once every dump has been read.
+    return {
+        'num_network_blocks': TOTAL_BLOCK_COUNT,
+        # JSON has no tuple keys
+        'route_sets': [[source, name, prefixes, nested] for (source, name), (prefixes, nested) in ROUTE_SETS.items()],
+        'route_set_rows': ROUTE_SET_ROWS
+    }
+
+
+def merge_state(snapshot: dict):
+    global TOTAL_BLOCK_COUNT
+    TOTAL_BLOCK_COUNT += snapshot['num_network_blocks']
+    for source, name, prefixes, nested in snapshot['route_sets']:
+        route_set = ROUTE_SETS.setdefault((source, name), ([], []))
+        route_set[0].extend(prefixes)
+        route_set[1].extend(nested)
+    ROUTE_SET_ROWS.extend(NetworkRow(*map(intern, row)) for row in snapshot['route_set_rows'])
+
+
+class NullWriter:
+    def writerow(self, row):
+        pass
+
+
+class WatchlistWriter:
+    # Matches every row against the watchlists as it is written
+    def __init__(self, writer):
+        self.writer = writer
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        WATCHLISTS.scan_fields(row)
+
+
+def is_state_block(block: bytes) -> bool:
+    # ARIN organisations and route-sets only add to the parser state, they
+    # are never written out as they are read.
+    return block.startswith(b'OrgID:') or block.startswith(b'route-set:')
+
+
+def copy_rows(src, dst):
+    # The final TSV file is put together from shards or parts; when there are
+    # watchlists every row is matched against them on its way through.
+    if WATCHLISTS is None:
+        shutil.copyfileobj(src, dst, DECOMPRESS_BUFFER_SIZE)
+        return
+    for line in src:
+        dst.write(line)
+        WATCHLISTS.scan_line(line)
+
+
+def parse_dumps(entries: list, output_file: str, checkpoint_dir: str = None, resume: bool = False):
+    '''
+    Parses the dumps into output_file. Without a checkpoint_dir the rows are
+    written straight to output_file. Otherwise each dump is written to a shard
+    in checkpoint_dir; every CHECKPOINT_BLOCKS blocks the shard is synced and
+    the manifest records how many blocks were parsed and the shard size at
+    that point. Finished dumps also save the parser state, so a resumed run
+    can skip them and continue the unfinished dump from its last checkpoint.
+    The shards are joined once every dump has been parsed, which makes the
+    output of a resumed run identical to that of a clean one.
+    '''
+    global CURRENT_FILENAME, TOTAL_BLOCK_COUNT
+    if checkpoint_dir is None:
+        reset_state()
+        with open(output_file, 'w') as output_file_handle:
+            csv_writer = csv.writer(output_file_handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+            if WATCHLISTS is not None:
+                csv_writer = WatchlistWriter(csv_writer)
+            for entry in entries:
+                CURRENT_FILENAME = entry
+                f_name = f"./databases/{entry}"
+                if not os.path.exists(f_name):
+                    logger.info(f"File {f_name} not found. Please download using download_dumps.sh")
+                    continue
                 logger.info(f"parsing database file: {f_name}")
                 start_time = time.time()
                 blocks = read_blocks(f_name)
                 logger.info(f"database parsing finished: {round(time.time() - start_time, 2)} seconds")
                 logger.info('parsing blocks')
                 start_time = time.time()
-                parse_blocks(blocks, csv_writer)
+                parse_blocks(blocks, csv_writer, get_source(entry))
                 logger.info(f"block parsing finished: {round(time.time() - start_time, 2)} seconds")
                 del blocks
-            else:
-                logger.info(f"File {f_name} not found. Please download using download_dumps.sh")
+                if entry == 'arin_db.txt':
+                    ARIN_ORGS.clear()
+        CURRENT_FILENAME = "empty"
+        return
+
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+    manifest = {}
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as handle:
+            manifest = json.load(handle)
+    elif os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
 
-            # "Free" the memory associated with the large dictionary since it is
-            # exclusive to ARIN's WHOIS database dump.
-            if entry == 'arin_db.txt':
-                del globals()['ARIN_ORGS']
+    def save_manifest():
+        with open(manifest_path + '.tmp', 'w') as handle:
+            json.dump(manifest, handle)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    previous_state = None
+    restored = False
+    for entry in entries:
+        CURRENT_FILENAME = entry
+        f_name = f"./databases/{entry}"
+        shard = os.path.join(checkpoint_dir, f"{entry}.tsv")
+        state_file = os.path.join(checkpoint_dir, f"{entry}.json")
+
+        # The state saved with a checkpoint includes that of every dump before
+        # it, so once one dump is parsed again all of the later ones are too.
+        dump_id = [os.path.getsize(f_name), os.path.getmtime(f_name)] if os.path.exists(f_name) else None
+        progress = manifest.get(entry)
+        if restored or (progress is not None and progress['dump'] != dump_id):
+            progress = None
+
+        if progress is not None and progress['done']:
+            logger.info(f"skipping finished database file: {f_name}")
+            previous_state = state_file
+            continue
+
+        if not restored:
+            reset_state()
+            if previous_state is not None:
+                with open(previous_state, 'r') as handle:
+                    merge_state(json.load(handle))
+            restored = True
+
+        if dump_id is not None:
+            logger.info(f"parsing database file: {f_name}")
+            start_time = time.time()
+            blocks = read_blocks(f_name)
+            logger.info(f"database parsing finished: {round(time.time() - start_time, 2)} seconds")
+
+            skip = 0
+            if progress is not None:
+                skip = progress['blocks']
+                logger.info(f"resuming at block {skip}")
+                with open(shard, 'r+b') as shard_handle:
+                    shard_handle.truncate(progress['offset'])
+                parse_blocks([block for block in blocks[:skip] if is_state_block(block)], NullWriter(), get_source(entry))
+                TOTAL_BLOCK_COUNT = progress['rows']
+
+            logger.info('parsing blocks')
+            start_time = time.time()
+            with open(shard, 'a' if progress is not None else 'w') as shard_handle:
+                csv_writer = csv.writer(shard_handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+                for start in range(skip, len(blocks), CHECKPOINT_BLOCKS):
+                    parse_blocks(blocks[start:start + CHECKPOINT_BLOCKS], csv_writer, get_source(entry))
+                    shard_handle.flush()
+                    os.fsync(shard_handle.fileno())
+                    manifest[entry] = {
+                        'dump': dump_id,
+                        'done': False,
+                        'blocks': min(start + CHECKPOINT_BLOCKS, len(blocks)),
+                        'offset': shard_handle.tell(),
+                        'rows': TOTAL_BLOCK_COUNT
+                    }
+                    save_manifest()
+            logger.info(f"block parsing finished: {round(time.time() - start_time, 2)} seconds")
+            del blocks
+        else:
+            logger.info(f"File {f_name} not found. Please download using download_dumps.sh")
+            open(shard, 'w').close()
+
+        # "Free" the memory associated with the large dictionary since it is
+        # exclusive to ARIN's WHOIS database dump.
+        if entry == 'arin_db.txt':
+            ARIN_ORGS.clear()
+
+        with open(state_file, 'w') as handle:
+            json.dump(state_snapshot(), handle)
+        manifest[entry] = {'dump': dump_id, 'done': True}
+        save_manifest()
+        previous_state = state_file
 
     CURRENT_FILENAME = "empty"
+
+    # Every dump was finished by an earlier run
+    if not restored:
+        reset_state()
+        if previous_state is not None:
+            with open(previous_state, 'r') as handle:
+                merge_state(json.load(handle))
+
+    with open(output_file, 'wb') as output_file_handle:
+        for entry in entries:
+            with open(os.path.join(checkpoint_dir, f"{entry}.tsv"), 'rb') as shard_handle:
+                copy_rows(shard_handle, output_file_handle)
+
+
+def part_paths(source: str) -> tuple:
+    return os.path.join(PARTS_DIR, f"{source}.tsv"), os.path.join(PARTS_DIR, f"{source}.json")
+
+
+def parse_source(source: str, checkpoint: bool = False, resume: bool = False) -> tuple:
+    '''
+    Parses the dumps of a single source into its own part: a TSV file with the
+    rows and a JSON file with the row count and the route-sets. Route-sets can
+    reference sets of other sources, so they are kept unresolved until
+    merge_parts() has all of them. Checkpoints are kept until the parts have
+    been merged, so a resumed run only re-reads the shards of a source which
+    had already finished.
+    '''
+    start_time = time.time()
+    tsv_path, json_path = part_paths(source)
+    checkpoint_dir = os.path.join(CHECKPOINT_DIR, source) if checkpoint else None
+    os.makedirs(PARTS_DIR, exist_ok=True)
+
+    parse_dumps([entry for entry in FILELIST if get_source(entry) == source], tsv_path, checkpoint_dir, resume)
+
+    with open(json_path, 'w') as handle:
+        json.dump(dict(state_snapshot(), source=source, created=datetime.now(timezone.utc).isoformat()), handle)
+
+    logger.info(f"{source} part finished: {TOTAL_BLOCK_COUNT} rows in {round(time.time() - start_time, 2)} seconds")
+    reset_state()
+    return tsv_path, json_path
+
+
+def merge_parts(parts: list, output_file: str) -> dict:
+    '''
+    Concatenates the parts written by parse_source() into a single TSV file and
+    appends the route-sets, resolved across every source. Returns when each
+    part was written, by source.
+    '''
+    start_time = time.time()
+    reset_state()
+
+    created = {}
+    with open(output_file, 'wb') as output_file_handle:
+        for tsv_path, json_path in parts:
+            logger.info(f"merging part: {tsv_path}")
+            with open(tsv_path, 'rb') as part:
+                copy_rows(part, output_file_handle)
+            with open(json_path, 'r') as handle:
+                snapshot = json.load(handle)
+            merge_state(snapshot)
+            created[snapshot['source']] = snapshot.get('created')
+
+    with open(output_file, 'a') as output_file_handle:
+        csv_writer = csv.writer(output_file_handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+        write_route_sets(csv_writer)
+        STRING_CACHE.clear()
+
+    logger.info(f"merge finished: {round(time.time() - start_time, 2)} seconds")
+    return created
+
+
+def upload_part(s3, source: str):
+    for path in part_paths(source):
+        s3.upload_file(path, S3_BUCKET, S3_PARTS_PREFIX + os.path.basename(path))
+
+
+def download_parts(s3) -> list:
+    # A source whose update task failed keeps its part from the previous update
+    # rather than dropping out of the build (and the delta) altogether; the
+    # part is reported as stale in the metadata, see part_status().
+    parts = []
+    os.makedirs(PARTS_DIR, exist_ok=True)
+    for source in SOURCES:
+        paths = part_paths(source)
+        try:
+            for path in paths:
+                s3.download_file(S3_BUCKET, S3_PARTS_PREFIX + os.path.basename(path), path)
+        except ClientError as ex:
+            logger.warning(f"No part available for {source}: {ex}")
+            continue
+        parts.append(paths)
+    return parts
+
+
+def download_update_start(s3) -> str:
+    # Written by the runtime when it starts the source tasks of an update
+    try:
+        res = s3.get_object(Bucket=S3_BUCKET, Key=S3_PARTS_PREFIX + 'update.json')
+    except ClientError as ex:
+        logger.warning(f"Unknown update start, parts can not be checked for staleness: {ex}")
+        return None
+    return json.loads(res['Body'].read())['started']
+
+
+def part_status(created: dict, started: str = None) -> dict:
+    '''
+    Returns when the part of each source was written and whether it is stale,
+    i.e. older than the update being merged because its source task failed
+    '''
+    status = {}
+    for source, timestamp in created.items():
+        stale = False
+        if started is not None:
+            stale = timestamp is None or datetime.fromisoformat(timestamp) < datetime.fromisoformat(started)
+        status[source] = {'created': timestamp, 'stale': stale}
+    return status
+
+
+def download_watchlists(s3, directory: str):
+    # Mirror the saved watchlists, a deleted one must not be evaluated again
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            os.remove(os.path.join(directory, filename))
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_WATCHLIST_PREFIX):
+        for obj in page.get('Contents', []):
+            filename = os.path.basename(obj['Key'])
+            if filename.endswith('.json'):
+                s3.download_file(S3_BUCKET, obj['Key'], os.path.join(directory, filename))
+
+
+def init_worker(decompressor: str):
+    # Workers only write parts, the watchlists are evaluated when they are merged
+    global DECOMPRESSOR, WATCHLISTS
+    DECOMPRESSOR = decompressor
+    WATCHLISTS = None
+
+
+def remove_checkpoints(names: list):
+    for name in names:
+        shutil.rmtree(os.path.join(CHECKPOINT_DIR, name), ignore_errors=True)
+
+
+def main(output_file, jobs=1, checkpoint=False, resume=False):
+    overall_start_time = time.time()
+
+    if jobs > 1:
+        # Every source is parsed in a process of its own and the parts are
+        # merged afterwards, the same as the per-source update tasks do.
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(DECOMPRESSOR,)) as executor:
+            parts = list(executor.map(parse_source, SOURCES, [checkpoint] * len(SOURCES), [resume] * len(SOURCES)))
+        merge_parts(parts, output_file)
+        if checkpoint:
+            remove_checkpoints(SOURCES)
+    else:
+        checkpoint_dir = os.path.join(CHECKPOINT_DIR, 'all') if checkpoint else None
+        parse_dumps(FILELIST, output_file, checkpoint_dir, resume)
+        with open(output_file, 'a') as output_file_handle:
+            csv_writer = csv.writer(output_file_handle, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+            write_route_sets(csv_writer)
+            STRING_CACHE.clear()
+        if checkpoint:
+            remove_checkpoints(['all'])
+
     logger.info(f"script finished: {round(time.time() - overall_start_time, 2)} seconds")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parse WHOIS databases into single TSV file')
     parser.add_argument('-d', action="store_true", dest='download_dumps')
-    parser.add_argument('-o', dest='output_file', type=str, required=True, help="Output TSV file")
+    parser.add_argument('-o', dest='output_file', type=str, help="Output TSV file")
+    parser.add_argument('--source', choices=SOURCES, help=f"Only download and parse this source into {PARTS_DIR}, see --merge")
+    parser.add_argument('--merge', action="store_true", help="Merge the parts of every source into the output TSV file")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Parse this many sources in parallel processes")
+    parser.add_argument('--watchlists', dest='watchlist_dir', type=str, default=WATCHLIST_DIR, help="Directory of watchlist JSON files to evaluate while writing the TSV file")
+    parser.add_argument('--checkpoint', action="store_true", help=f"Checkpoint the progress to {CHECKPOINT_DIR} so an interrupted run can be resumed (local runs only)")
+    parser.add_argument('--resume', action="store_true", help=f"Continue an interrupted run from its checkpoints in {CHECKPOINT_DIR}, implies --checkpoint")
+    parser.add_argument('--previous', dest='previous_file', type=str, help="TSV file of the previous build to compute a delta against")
+    parser.add_argument('--delta', dest='delta_file', type=str, default='delta.tsv', help="Output delta TSV file")
+    parser.add_argument('--decompressor', choices=['auto'] + DECOMPRESSORS, default=DECOMPRESSOR, help="gzip decompression backend")
     parser.add_argument('--debug', action="store_true", help="set loglevel to DEBUG")
     parser.add_argument('--version', action='version', version=f"%(prog)s {VERSION}")
     args = parser.parse_args()
     secret_arin_api_key = None
 
+    if args.output_file is None and args.source is None:
+        parser.error('-o is required unless --source is given')
+
     # If there is no ARIN key defined, check Secrets Manager and export as environment key
     if ARIN_API_KEY in ['', None] and ARIN_SECRET_NAME not in ['', None]:
         secretsmanager = boto3.client('secretsmanager')
@@ -365,15 +985,92 @@ if __name__ == '__main__':
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
+    DECOMPRESSOR = args.decompressor
+
     # Include ARIN API key as needed
     if args.download_dumps:
         env = os.environ.copy()
         if secret_arin_api_key not in [None, '', 'NONE']:
             env['ARIN_API_KEY'] = secret_arin_api_key
-        sp.run('bash ./download_dumps.sh', env=env, shell=True)
+        sp.run(' '.join(['bash ./download_dumps.sh'] + ([args.source] if args.source else [])), env=env, shell=True)
+
+    # A per-source update task only produces its part, publishing the build is
+    # left to the task which merges all of them.
+    if args.source is not None:
+        parse_source(args.source, args.checkpoint or args.resume, args.resume)
+        if not any([req in ['', None] for req in [S3_BUCKET, S3_PARTS_PREFIX]]):
+            logger.info('Found S3 configuration, uploading part to desired path')
+            upload_part(boto3.client('s3'), args.source)
+        sys.exit(0)
+
+    # Watchlists are evaluated in the same pass that writes the TSV file
+    if not any([req in ['', None] for req in [S3_BUCKET, S3_WATCHLIST_PREFIX]]):
+        logger.info('Found S3 configuration, downloading watchlists')
+        download_watchlists(boto3.client('s3'), args.watchlist_dir)
+    watchlists = load_watchlists(args.watchlist_dir)
+    if watchlists:
+        logger.info(f"evaluating {len(watchlists)} watchlists")
+        WATCHLISTS = WatchlistScanner(watchlists)
 
-    # Run default script to generate TSV file
-    main(args.output_file)
+    parts_status = None
+    if args.merge:
+        started = None
+        if not any([req in ['', None] for req in [S3_BUCKET, S3_PARTS_PREFIX]]):
+            logger.info('Found S3 configuration, downloading parts')
+            s3 = boto3.client('s3')
+            parts = download_parts(s3)
+            started = download_update_start(s3)
+            # A published build without a source would also report every
+            # block of it as removed in the delta
+            missing = [source for source in SOURCES if part_paths(source) not in parts]
+            if missing:
+                logger.error(f"No part for {', '.join(missing)}, refusing to publish a build without them")
+                sys.exit(1)
+        else:
+            parts = [paths for paths in map(part_paths, SOURCES) if all(os.path.exists(path) for path in paths)]
+        if not parts:
+            logger.error("No parts to merge, run with --source first")
+            sys.exit(1)
+        parts_status = part_status(merge_parts(parts, args.output_file), started)
+        stale = [source for source in parts_status if parts_status[source]['stale']]
+        if stale:
+            logger.warning(f"Merged stale parts of {', '.join(stale)}")
+        remove_checkpoints(SOURCES)
+    else:
+        # Run default script to generate TSV file
+        main(args.output_file, args.jobs, args.checkpoint or args.resume, args.resume)
+
+    watchlist_counts = None
+    if WATCHLISTS is not None:
+        watchlist_counts = WATCHLISTS.write_results(WATCHLIST_RESULTS_DIR)
+        logger.info(f"watchlist results: {watchlist_counts}")
+        if not any([req in ['', None] for req in [S3_BUCKET, S3_WATCHLIST_RESULTS_PREFIX]]):
+            logger.info('Found S3 configuration, uploading watchlist results')
+            s3 = boto3.client('s3')
+            for name in watchlist_counts:
+                s3.upload_file(os.path.join(WATCHLIST_RESULTS_DIR, f"{name}.tsv"), S3_BUCKET, f"{S3_WATCHLIST_RESULTS_PREFIX}{name}.tsv")
+
+    # Fetch the previous build before it gets overwritten by this one
+    previous_file = args.previous_file
+    if previous_file is None and not any([req in ['', None] for req in [S3_BUCKET, S3_PATH, S3_DELTA_PATH]]):
+        logger.info('Found S3 configuration, downloading previous build')
+        s3 = boto3.client('s3')
+        try:
+            s3.download_file(S3_BUCKET, S3_PATH, 'previous_network_info.tsv')
+            previous_file = 'previous_network_info.tsv'
+        except ClientError as ex:
+            logger.info(f"No previous build available: {ex}")
+
+    # A build which is about to be published is sorted in place, which also
+    # means the next build can merge against it without sorting it again. Any
+    # other input is left untouched.
+    delta_counts = None
+    if previous_file is not None:
+        logger.info(f"computing delta against {previous_file}")
+        start_time = time.time()
+        publish = not any([req in ['', None] for req in [S3_BUCKET, S3_PATH]])
+        delta_counts = compute_delta(previous_file, args.output_file, args.delta_file, sort_new_in_place=publish)
+        logger.info(f"delta finished: {delta_counts} in {round(time.time() - start_time, 2)} seconds")
 
     # Upload the files to S3 if we need to
     if not any([req in ['', None] for req in [S3_BUCKET, S3_PATH]]):
@@ -381,6 +1078,11 @@ if __name__ == '__main__':
         s3 = boto3.client('s3')
         s3.upload_file(args.output_file, S3_BUCKET, S3_PATH)
 
+    if delta_counts is not None and not any([req in ['', None] for req in [S3_BUCKET, S3_DELTA_PATH]]):
+        logger.info('Found S3 configuration, uploading delta to desired path')
+        s3 = boto3.client('s3')
+        s3.upload_file(args.delta_file, S3_BUCKET, S3_DELTA_PATH)
+
     # Update metadata if we need to
     if not any([req in ['', None] for req in [S3_BUCKET, S3_METADATA_PATH]]):
         logger.info('Found S3 configuration, uploading metadata desired path')
@@ -389,6 +1091,9 @@ if __name__ == '__main__':
             handle.write(json.dumps({
                 'system_version': SYSTEM_VERSION,
                 'num_network_blocks': TOTAL_BLOCK_COUNT,
+                'delta': delta_counts,
+                'watchlists': watchlist_counts,
+                'parts': parts_status,
                 'last_update': datetime.now().isoformat()
             }))
         s3.upload_file('metadata.json', S3_BUCKET, S3_METADATA_PATH)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+'''
+Evaluates saved watchlists against the TSV file generated with the parser.py
+script. A watchlist is a JSON file, named after the watchlist, with the keywords
+to look for and optionally the sources to restrict them to:
+
+    {"keywords": ["acme", "ACME-MNT"], "sources": ["arin", "ripe"]}
+
+The keywords of every watchlist are compiled into a single automaton, so the
+TSV file is read once no matter how many watchlists there are. Rows are matched
+the same way as with keyword_scan.py; the matches of each watchlist are reduced
+with cidr_reduce.py and written to <name>.tsv with the keywords which matched in
+an extra trailing column.
+
+parser.py evaluates the watchlists in ./watchlists while it writes the TSV file;
+this script does the same for an existing TSV file.
+
+Suggested usage:
+    python3 watchlist.py -w ./watchlists -o ./watchlist-results network_info.tsv
+'''
+
+import os
+import re
+import sys
+import json
+import argparse
+
+import cidr_reduce
+
+from keyword_scan import KeywordAutomaton, SEARCH_COLUMNS, SOURCE_COLUMN, FIELD_SEPARATOR, strip_wildcards
+
+
+def load_watchlists(directory: str) -> dict:
+    '''
+    Returns {name: (keywords, sources)} for every watchlist in directory; an
+    empty set of sources matches every source. Watchlists with keywords that
+    can not be matched literally are skipped.
+    '''
+    watchlists = {}
+    if not os.path.isdir(directory):
+        return watchlists
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(directory, filename), 'r') as handle:
+            definition = json.load(handle)
+        try:
+            keywords = [strip_wildcards(str(keyword)) for keyword in definition.get('keywords', [])]
+        except ValueError as ex:
+            sys.stderr.write(f"Skipping watchlist {filename}: {ex}\n")
+            continue
+        sources = set(str(source).lower() for source in definition.get('sources', []))
+        if '%' in sources:
+            sources = set()
+        watchlists[filename[:-len('.json')]] = ([keyword for keyword in keywords if keyword], sources)
+    return watchlists
+
+
+def is_reducible(row: list) -> bool:
+    # cidr_reduce.py expects a CIDR block in the first column
+    if '/' not in row[0]:
+        return False
+    try:
+        cidr_reduce.ip_to_int(row)
+        int(row[0].split('/')[1])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+
+class WatchlistScanner:
+    '''
+    Collects the rows matching any of a set of watchlists
+    '''
+
+    def __init__(self, watchlists: dict):
+        self.names = list(watchlists)
+        self.sources = [watchlists[name][1] for name in self.names]
+        self.matches = [[] for _ in self.names]
+        self.automaton = KeywordAutomaton([keyword for name in self.names for keyword in watchlists[name][0]])
+
+        # automaton keyword index -> (watchlist index, position of the keyword
+        # in that watchlist) for every watchlist it belongs to
+        index = {keyword: i for i, keyword in enumerate(self.automaton.keywords)}
+        self._owners = [[] for _ in self.automaton.keywords]
+        for w, name in enumerate(self.names):
+            for position, keyword in enumerate(dict.fromkeys(watchlists[name][0])):
+                if keyword in index:
+                    self._owners[index[keyword]].append((w, position))
+
+        # Almost no row matches anything. A regular expression over the same
+        # keywords rejects those rows without leaving C; it is only exact for
+        # ASCII, where IGNORECASE and casefold() agree.
+        self._prefilter = None
+        if self.automaton.keywords and all(keyword.isascii() for keyword in self.automaton.keywords):
+            self._prefilter = re.compile(
+                b'|'.join(re.escape(keyword.encode()) for keyword in self.automaton.keywords),
+                re.IGNORECASE
+            )
+
+    def scan_line(self, line: bytes):
+        if self._prefilter is not None and line.isascii() and not self._prefilter.search(line):
+            return
+        self.scan_fields(line.decode('utf-8', 'ignore').rstrip('\r\n').split('\t'))
+
+    def scan_fields(self, fields: list):
+        text = FIELD_SEPARATOR.join(fields[i] or '' for i in SEARCH_COLUMNS if i < len(fields))
+        found = self.automaton.search(text)
+        if not found:
+            return
+
+        matched = {}
+        for i in found:
+            for w, position in self._owners[i]:
+                matched.setdefault(w, []).append((position, self.automaton.keywords[i]))
+
+        source = (fields[SOURCE_COLUMN] or '').lower() if len(fields) > SOURCE_COLUMN else ''
+        for w, keywords in matched.items():
+            if self.sources[w] and source not in self.sources[w]:
+                continue
+            keywords.sort()
+            self.matches[w].append([field or '' for field in fields] + [','.join(keyword for _, keyword in keywords)])
+
+    def write_results(self, directory: str) -> dict:
+        '''
+        Writes the reduced matches of each watchlist to <name>.tsv in directory
+        and returns the number of rows written per watchlist
+        '''
+        os.makedirs(directory, exist_ok=True)
+        counts = {}
+        for name, rows in zip(self.names, self.matches):
+            # Rows without a usable CIDR block can not be reduced, they are
+            # kept as they are rather than dropped from the results.
+            reducible = [row for row in rows if is_reducible(row)]
+            rows = cidr_reduce.reduce_rows(reducible) + [row for row in rows if not is_reducible(row)]
+            with open(os.path.join(directory, f"{name}.tsv"), 'w') as handle:
+                for row in rows:
+                    handle.write('\t'.join(row) + '\n')
+            counts[name] = len(rows)
+        return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate watchlists against a SHADOWSTAR TSV file')
+    parser.add_argument('-w', dest='watchlist_dir', type=str, default='./watchlists', help="Directory of watchlist JSON files")
+    parser.add_argument('-o', dest='output_dir', type=str, default='./watchlist-results', help="Directory to write the results to")
+    parser.add_argument('files', nargs='*', help="TSV files to search (default: stdin)")
+    args = parser.parse_args()
+
+    watchlists = load_watchlists(args.watchlist_dir)
+    if not watchlists:
+        sys.stderr.write(f"No watchlists found in {args.watchlist_dir}\n")
+        sys.exit(1)
+
+    scanner = WatchlistScanner(watchlists)
+    for path in args.files or ['-']:
+        with (open(path, 'rb') if path != '-' else open(sys.stdin.fileno(), 'rb', closefd=False)) as handle:
+            for line in handle:
+                scanner.scan_line(line)
+
+    for name, count in scanner.write_results(args.output_dir).items():
+        sys.stderr.write(f"{name}: {count}\n")